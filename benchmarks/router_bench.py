@@ -0,0 +1,110 @@
+"""Замер накладных расходов MessageRouter против прежней цепочки startswith.
+
+Запуск: python benchmarks/router_bench.py [--number 200]
+
+Сначала сверяет, что роутер выбирает тот же триггер, что и старая цепочка
+(кроме намеренных отличий вроде /ask@botname), затем меряет время на
+сообщение отдельно для обычной переписки и для команд. Код возврата 1,
+если хоть один триггер не совпал.
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1")
+
+from main import router  # noqa: E402
+
+CHAT_WORDS = ["привет", "как", "дела", "сегодня", "завтра", "контрольная", "кто", "идет", "в", "кино",
+              "ок", "лол", "да", "нет", "а", "домашка", "по", "алгебре", "скинь", "пожалуйста", "😂", "👍"]
+
+COMMANDS = [
+    "/ask сколько будет 2+2",
+    "/ask@snailbot что такое фотосинтез",
+    "улитка, реши уравнение x^2 = 4",
+    "Улитка кто написал Войну и мир",
+    "/all",
+    "/tagall собираемся",
+    '/tip "Капитан" "@vasya"',
+    "/cache",
+]
+
+ALIASES = {"tagall": "all", "улитка": "ask"}
+
+# Прежняя цепочка отдавала /ask@otherbot себе, роутер - нет
+INTENTIONAL = {"/ask@otherbot вопрос": ("ask", None)}
+
+
+def legacy_route(text):
+    text = text.strip()
+    text_lower = text.lower()
+    if text.startswith('/tip'):
+        return "tip"
+    if text.startswith('/all') or text.startswith('/tagall'):
+        return "all"
+    if text.startswith('/ask') or text_lower.startswith('улитка'):
+        return "ask"
+    if text.startswith('/cache'):
+        return "cache"
+    return None
+
+
+def new_route(text):
+    found = router.match(text.strip())
+    if found is None:
+        return None
+    return ALIASES.get(found[0], found[0])
+
+
+def chat_corpus(count, seed):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(CHAT_WORDS) for _ in range(rng.randint(1, 12))) for _ in range(count)]
+
+
+def check(texts):
+    failures = 0
+    for text in texts:
+        if new_route(text) != legacy_route(text):
+            failures += 1
+            print(f"mismatch: {text!r}: legacy={legacy_route(text)!r} router={new_route(text)!r}")
+    for text, (legacy, new) in INTENTIONAL.items():
+        if legacy_route(text) != legacy or new_route(text) != new:
+            failures += 1
+            print(f"intentional difference changed: {text!r}")
+    return failures
+
+
+def bench(title, texts, number):
+    legacy_time = min(timeit.repeat(lambda: [legacy_route(t) for t in texts], number=number, repeat=3))
+    new_time = min(timeit.repeat(lambda: [new_route(t) for t in texts], number=number, repeat=3))
+    per_message = number * len(texts)
+    print(f"{title}: {len(texts)} messages, {number} rounds")
+    print(f"  legacy chain:  {legacy_time / per_message * 1e9:8.1f} ns/message")
+    print(f"  MessageRouter: {new_time / per_message * 1e9:8.1f} ns/message")
+    print(f"  speedup:       {legacy_time / new_time:8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    router.bot_username = "snailbot"
+    chat = chat_corpus(1000, args.seed)
+    failures = check(chat + COMMANDS)
+    print(f"routing: {len(chat) + len(COMMANDS) - failures}/{len(chat) + len(COMMANDS)} match")
+    if failures:
+        sys.exit(1)
+    bench("plain chat", chat, args.number)
+    bench("commands", COMMANDS * 100, args.number)
+
+
+if __name__ == "__main__":
+    main()
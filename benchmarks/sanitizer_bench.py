@@ -0,0 +1,143 @@
+"""Проверка и замер AnswerSanitizer против прежней цепочки из восьми re.sub.
+
+Запуск: python benchmarks/sanitizer_bench.py [--number 2000] [--fuzz 100000]
+
+Сначала сверяет результат с эталонами из sanitizer_corpus.json (и, если
+указан --fuzz, со старой цепочкой на случайных строках) и проверяет, что
+потоковое превью растет после одиночного $, затем меряет время на ответ.
+Код возврата 1, если хоть одна проверка не прошла.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1")
+
+from main import sanitizer  # noqa: E402
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sanitizer_corpus.json")
+
+FUZZ_TOKENS = ["a", " ", "\n", "\n\n", "[1]", "[12]", "[", "]", "1", "2.", "-", "•", "*", "**",
+               "$", "$$", "\\[", "\\]", "\\(", "\\)", "слово ", ".", " - ", "\t"]
+
+
+def legacy_clean(answer):
+    answer = re.sub(r'\[(\d+)\]', '', answer)
+    answer = re.sub(r'\\\[.*?\\\]', '', answer, flags=re.DOTALL)
+    answer = re.sub(r'\\\(.*?\\\)', '', answer, flags=re.DOTALL)
+    answer = re.sub(r'\$\$.*?\$\$', '', answer, flags=re.DOTALL)
+    answer = re.sub(r'\$[^\$]+\$', '', answer)
+    answer = re.sub(r'\*\*', '', answer)
+    answer = re.sub(r'^\s*[-•]\s*', '', answer, flags=re.MULTILINE)
+    answer = re.sub(r'^\s*\d+\.\s*', '', answer, flags=re.MULTILINE)
+    return answer.strip()
+
+
+def check_corpus(corpus):
+    failures = 0
+    for i, case in enumerate(corpus):
+        got = sanitizer.clean(case["input"])
+        if got != case["expected"]:
+            failures += 1
+            print(f"corpus #{i}: mismatch\n  expected: {case['expected']!r}\n  got:      {got!r}")
+    return failures
+
+
+def check_fuzz(count, seed):
+    rng = random.Random(seed)
+    failures = 0
+    for _ in range(count):
+        text = "".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(1, 20)))
+        if sanitizer.clean(text) != legacy_clean(text):
+            failures += 1
+            if failures <= 5:
+                print(f"fuzz mismatch: {text!r}")
+    return failures
+
+
+def stream_answer(text, chunk=8):
+    """Кормит ответ потоку кусками, как SSE; возвращает длины превью по ходу."""
+    cleaner = sanitizer.stream()
+    previews = []
+    for i in range(0, len(text), chunk):
+        cleaner.feed(text[i:i + chunk])
+        previews.append(len(cleaner.preview()))
+    return previews
+
+
+def check_stream(corpus):
+    # "$5" без пары не должен замораживать превью до конца ответа
+    paragraphs = [case["input"].replace("$", "") for case in corpus if "\n" not in case["input"]] or ["абзац ответа"]
+    text = "Это стоит $5.\n\n" + "\n\n".join(paragraphs * (20 // len(paragraphs) + 1))
+    previews = stream_answer(text)
+    half = previews[len(previews) // 2]
+    if half < len(text) // 4:
+        print(f"stream: preview stuck at {half} of {len(text)} chars after a lone $")
+        return 1
+    return 0
+
+
+def bench_stream(texts, number):
+    longest = max(texts, key=len)
+    answer = "Это стоит $5.\n\n" + "\n\n".join([longest] * max(1, 13000 // len(longest)))
+    seconds = min(timeit.repeat(lambda: stream_answer(answer), number=max(1, number // 100), repeat=3))
+    print(f"stream: {len(answer)} chars in 8-char chunks with a lone $, "
+          f"{seconds / max(1, number // 100) * 1e3:.2f} ms/answer")
+
+
+def bench(title, texts, number):
+    total_chars = sum(len(t) for t in texts)
+
+    def run_legacy():
+        for t in texts:
+            legacy_clean(t)
+
+    def run_new():
+        for t in texts:
+            sanitizer.clean(t)
+
+    legacy_time = min(timeit.repeat(run_legacy, number=number, repeat=3))
+    new_time = min(timeit.repeat(run_new, number=number, repeat=3))
+    per_answer = number * len(texts)
+    print(f"{title}: {len(texts)} answers, {total_chars} chars, {number} rounds")
+    print(f"  legacy chain:    {legacy_time / per_answer * 1e6:8.2f} us/answer")
+    print(f"  AnswerSanitizer: {new_time / per_answer * 1e6:8.2f} us/answer")
+    print(f"  speedup:         {legacy_time / new_time:8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--fuzz", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(CORPUS_FILE, "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    failures = check_corpus(corpus)
+    print(f"corpus: {len(corpus) - failures}/{len(corpus)} match")
+    failures += check_stream(corpus)
+    if args.fuzz:
+        fuzz_failures = check_fuzz(args.fuzz, args.seed)
+        print(f"fuzz: {args.fuzz - fuzz_failures}/{args.fuzz} match")
+        failures += fuzz_failures
+    if failures:
+        sys.exit(1)
+    texts = [case["input"] for case in corpus]
+    bench("all", texts, args.number)
+    bench("without formulas", [t for t in texts if "$" not in t and "\\" not in t], args.number)
+    bench("with formulas", [t for t in texts if "$" in t or "\\" in t], args.number)
+    bench_stream(texts, args.number)
+
+
+if __name__ == "__main__":
+    main()
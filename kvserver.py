@@ -0,0 +1,228 @@
+"""Локальная замена общего key-value сервера для STATE_BACKEND=kv.
+
+Понимает подмножество протокола Redis (RESP), которым пользуется бот:
+PING, GET, SET (с NX, XX, PX, EX), DEL, EXISTS, SCAN, KEYS, SELECT, AUTH,
+FLUSHDB и транзакции WATCH/MULTI/EXEC/DISCARD/UNWATCH. Несколько процессов
+бота могут подключиться к одному серверу и делить состояние игр и FSM.
+С --dump данные переживают перезапуск сервера, ключи со сроком жизни
+(аренды) не сохраняются.
+
+Запуск: python kvserver.py [--host 127.0.0.1] [--port 6380] [--dump /data/kv.json]
+"""
+import argparse
+import asyncio
+import base64
+import fnmatch
+import json
+import itertools
+import logging
+import os
+import time
+
+
+class Session:
+    """Состояние транзакции одного соединения."""
+
+    def __init__(self):
+        self.watched = {}
+        self.queue = None
+
+
+class KVServer:
+    def __init__(self, dump_path: str = None, save_interval: float = 5.0):
+        self.data = {}
+        # Версия ключа растет при каждом изменении, по ней EXEC проверяет WATCH
+        self.versions = {}
+        self.expires = {}
+        self.counter = itertools.count(1)
+        self.dump_path = dump_path
+        self.save_interval = save_interval
+        self.dirty = False
+
+    def load(self):
+        if not self.dump_path or not os.path.exists(self.dump_path):
+            return
+        with open(self.dump_path, "r", encoding="utf-8") as f:
+            self.data = {k.encode(): base64.b64decode(v) for k, v in json.load(f).items()}
+        logging.info(f"Loaded {len(self.data)} keys from {self.dump_path}")
+
+    def save(self):
+        if not self.dump_path or not self.dirty:
+            return
+        self.dirty = False
+        tmp_path = self.dump_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({k.decode(): base64.b64encode(v).decode() for k, v in self.data.items() if k not in self.expires}, f)
+        os.replace(tmp_path, self.dump_path)
+
+    async def run_saver(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            self.save()
+
+    def touch(self, key: bytes):
+        self.versions[key] = next(self.counter)
+
+    def purge(self):
+        now = time.monotonic()
+        for key in [key for key, deadline in self.expires.items() if deadline <= now]:
+            del self.expires[key]
+            self.data.pop(key, None)
+            self.touch(key)
+
+    def dispatch(self, args: list, session: Session):
+        self.purge()
+        name = args[0].upper()
+        if name == b"MULTI":
+            session.queue = []
+            return "OK"
+        if name == b"EXEC":
+            if session.queue is None:
+                return ValueError("ERR EXEC without MULTI")
+            queue, session.queue = session.queue, None
+            watched, session.watched = session.watched, {}
+            if any(self.versions.get(key, 0) != version for key, version in watched.items()):
+                return None
+            # Сервер однопоточный: команды очереди выполняются подряд, без чужих между ними
+            return [self.execute(command) for command in queue]
+        if name == b"DISCARD":
+            session.queue = None
+            session.watched = {}
+            return "OK"
+        if session.queue is not None:
+            session.queue.append(args)
+            return "QUEUED"
+        if name == b"WATCH":
+            for key in args[1:]:
+                session.watched[key] = self.versions.get(key, 0)
+            return "OK"
+        if name == b"UNWATCH":
+            session.watched = {}
+            return "OK"
+        return self.execute(args)
+
+    def execute(self, args: list):
+        name = args[0].upper()
+        if name == b"PING":
+            return "PONG"
+        if name in (b"SELECT", b"AUTH"):
+            return "OK"
+        if name == b"GET":
+            return self.data.get(args[1])
+        if name == b"SET":
+            key, options = args[1], [arg.upper() for arg in args[3:]]
+            if b"NX" in options and key in self.data or b"XX" in options and key not in self.data:
+                return None
+            self.data[key] = args[2]
+            self.expires.pop(key, None)
+            for option, scale in ((b"PX", 0.001), (b"EX", 1.0)):
+                if option in options:
+                    self.expires[key] = time.monotonic() + int(options[options.index(option) + 1]) * scale
+            self.touch(key)
+            self.dirty = self.dirty or key not in self.expires
+            return "OK"
+        if name == b"DEL":
+            removed = 0
+            for key in args[1:]:
+                if self.data.pop(key, None) is not None:
+                    removed += 1
+                    self.expires.pop(key, None)
+                    self.touch(key)
+            self.dirty = self.dirty or bool(removed)
+            return removed
+        if name == b"EXISTS":
+            return sum(key in self.data for key in args[1:])
+        if name == b"KEYS":
+            return self.match(args[1])
+        if name == b"SCAN":
+            # Курсор не нужен: ключей мало, отдаем все за один проход
+            options = {args[i].upper(): args[i + 1] for i in range(2, len(args) - 1, 2)}
+            return [b"0", self.match(options.get(b"MATCH", b"*"))]
+        if name == b"FLUSHDB":
+            for key in self.data:
+                self.touch(key)
+            self.data.clear()
+            self.expires.clear()
+            self.dirty = True
+            return "OK"
+        return ValueError(f"ERR unknown command '{name.decode(errors='replace')}'")
+
+    def match(self, pattern: bytes) -> list:
+        pattern = pattern.decode()
+        return [key for key in self.data if fnmatch.fnmatchcase(key.decode(), pattern)]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = Session()
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                writer.write(encode_reply(self.dispatch(args, session)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            logging.warning(f"Client dropped: {e}")
+        finally:
+            writer.close()
+
+
+async def read_command(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Inline-команда, например из telnet
+        return line.split()
+    args = []
+    for _ in range(int(line[1:-2])):
+        header = await reader.readline()
+        if not header.startswith(b"$"):
+            raise ValueError(f"bad bulk header {header!r}")
+        args.append((await reader.readexactly(int(header[1:-2]) + 2))[:-2])
+    return args
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, ValueError):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+async def serve(args):
+    kv = KVServer(args.dump, args.save_interval)
+    kv.load()
+    server = await asyncio.start_server(kv.handle, args.host, args.port)
+    saver = asyncio.create_task(kv.run_saver())
+    logging.info(f"KV server listening on {args.host}:{args.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        saver.cancel()
+        kv.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    parser.add_argument("--dump", default=None)
+    parser.add_argument("--save-interval", type=float, default=5.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
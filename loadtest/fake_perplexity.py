@@ -0,0 +1,124 @@
+"""Поддельный Perplexity chat/completions для нагрузочных прогонов.
+
+Задержка до первого токена (--latency ± --jitter), доля ответов 429
+(--rate-429) и потоковая отдача (SSE, если бот прислал "stream": true)
+настраиваются. Ответ похож на настоящий: со ссылками [1] и **выделением**,
+чтобы санитайзер работал как в жизни, и с полем usage.
+
+Отдельный запуск:
+python loadtest/fake_perplexity.py [--port 8082] [--latency 1.5] [--rate-429 0.05]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+
+from aiohttp import web
+
+FILLER = [
+    "Это зависит от условий задачи [1].",
+    "Обычно начинают с **самого простого** случая.",
+    "Дальше подставляем значения и проверяем ответ [2].",
+    "Если что-то не сходится, стоит перепроверить исходные данные.",
+    "Подробнее можно почитать в учебнике за 8 класс [3].",
+]
+
+
+class FakePerplexity:
+    def __init__(self, latency: float = 1.0, jitter: float = 0.5, rate_429: float = 0.0,
+                 chunk_chars: int = 40, chunk_interval: float = 0.05, answer_sentences: int = 8, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.chunk_chars = chunk_chars
+        self.chunk_interval = chunk_interval
+        self.answer_sentences = answer_sentences
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+        self.streamed = 0
+        self.active = 0
+        self.peak_active = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/chat/completions", self.handle)
+        return app
+
+    def answer_for(self, question: str) -> str:
+        sentences = [f"Ответ на вопрос «{question[:60]}»."]
+        sentences += [self.rng.choice(FILLER) for _ in range(self.answer_sentences)]
+        return " ".join(sentences)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        if self.rng.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({"error": {"message": "rate limited"}}, status=429, headers={"Retry-After": "1"})
+        content = body["messages"][-1]["content"]
+        if isinstance(content, list):
+            content = next((part["text"] for part in content if part.get("type") == "text"), "")
+        answer = self.answer_for(content)
+        usage = {"prompt_tokens": sum(len(str(m["content"])) for m in body["messages"]) // 4,
+                 "completion_tokens": len(answer) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+            if body.get("stream"):
+                self.streamed += 1
+                return await self.stream(request, body["model"], answer, usage)
+            return web.json_response({
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        finally:
+            self.active -= 1
+
+    async def stream(self, request: web.Request, model: str, answer: str, usage: dict) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for i in range(0, len(answer), self.chunk_chars):
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": answer[i:i + self.chunk_chars]},
+                                                  "finish_reason": None}]}
+            await resp.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+            await asyncio.sleep(self.chunk_interval)
+        final = {"model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        await resp.write(b"data: " + json.dumps(final).encode() + b"\n\n")
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+
+async def serve(args):
+    fake = FakePerplexity(args.latency, args.jitter, args.rate_429, seed=args.seed)
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logging.info(f"Fake Perplexity on http://{args.host}:{args.port}/chat/completions (PERPLEXITY_API_URL)")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
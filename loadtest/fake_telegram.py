@@ -0,0 +1,167 @@
+"""Поддельный Telegram Bot API для нагрузочных прогонов.
+
+Отвечает на методы, которые вызывает бот: getMe, getUpdates, sendMessage,
+editMessageText, sendChatAction, answerCallbackQuery, getFile и скачивание
+файла, а также на служебные вызовы aiogram при старте. Апдейты подкладывает
+генератор нагрузки через push_update(), каждый вызов бота записывается в
+calls, чтобы потом посчитать задержки.
+
+Отдельный запуск (например, чтобы погонять бота руками):
+python loadtest/fake_telegram.py [--port 8081] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import logging
+import os
+import time
+
+from aiohttp import web
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Улитка", "username": "snailbot"}
+
+
+def make_photo(side: int) -> bytes:
+    """JPEG side x 3/4 side; без Pillow - случайные байты похожего размера."""
+    if Image is None:
+        return os.urandom(side * side // 8)
+    img = Image.linear_gradient("L").resize((side, side * 3 // 4)).convert("RGB")
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, photo_side: int = 1280):
+        self.latency = latency
+        self.photo = make_photo(photo_side)
+        self.pending = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1_000_000)
+        self.new_updates = asyncio.Event()
+        self.first_poll = asyncio.Event()
+        # (время, метод, параметры, результат) каждого вызова бота, кроме getUpdates
+        self.calls = []
+        self.delivered = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+    def push_update(self, update: dict) -> int:
+        update["update_id"] = next(self.update_ids)
+        self.pending.append(update)
+        self.new_updates.set()
+        return update["update_id"]
+
+    def next_message_id(self) -> int:
+        return next(self.message_ids)
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.body_exists:
+            params.update(await request.post())
+        if method == "getUpdates":
+            result = await self.get_updates(params)
+        else:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            handler = getattr(self, f"api_{method}", None)
+            result = handler(params) if handler else True
+            self.calls.append((time.perf_counter(), method, params, result))
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+    async def get_updates(self, params: dict) -> list:
+        self.first_poll.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        if offset < 0:
+            # skip_updates при старте: пропускать нечего
+            return []
+        if offset:
+            confirmed = 0
+            while confirmed < len(self.pending) and self.pending[confirmed]["update_id"] < offset:
+                confirmed += 1
+            del self.pending[:confirmed]
+        if not self.pending and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = self.pending[:limit]
+        now = time.perf_counter()
+        for update in batch:
+            self.delivered.setdefault(update["update_id"], now)
+        return batch
+
+    def _message(self, chat_id: int, text: str, message_id: int = None) -> dict:
+        return {
+            "message_id": message_id or self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    def api_getMe(self, params: dict):
+        return BOT_USER
+
+    def api_getWebhookInfo(self, params: dict):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": len(self.pending)}
+
+    def api_sendMessage(self, params: dict):
+        return self._message(int(params["chat_id"]), params.get("text", ""))
+
+    def api_editMessageText(self, params: dict):
+        return self._message(int(params["chat_id"]), params.get("text", ""), int(params["message_id"]))
+
+    def api_getFile(self, params: dict):
+        return {
+            "file_id": params["file_id"],
+            "file_unique_id": params["file_id"],
+            "file_size": len(self.photo),
+            "file_path": f"photos/{params['file_id']}.jpg",
+        }
+
+
+async def serve(args):
+    fake = FakeTelegram(args.latency, args.photo_side)
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logging.info(f"Fake Telegram Bot API on http://{args.host}:{args.port} (TELEGRAM_API_URL)")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--photo-side", type=int, default=1280)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+"""Нагрузочный прогон main.py против поддельных Telegram и Perplexity.
+
+Запуск: python loadtest/run.py [--duration 30] [--groups 4] [--ask-rate 2] ...
+
+Поднимает fake_telegram и fake_perplexity в этом процессе и запускает бота
+отдельным процессом (polling, состояние во временной папке). Затем подает
+синтетическую нагрузку групповых чатов:
+- обычную переписку;
+- /ask и всплески одинаковых вопросов;
+- фото с подписью;
+- /all в большой группе;
+- партии в мафию с короткими фазами.
+
+В конце печатает p50/p95/p99 задержек по сценариям, пропускную способность
+и пиковый RSS бота. С --save результат пишется в JSON. С --baseline он
+сравнивается с прошлым прогоном, и код возврата 1 означает, что p95
+какого-то сценария или пиковый RSS выросли больше чем на --tolerance.
+
+По умолчанию лимиты Telegram и LLM у бота ослаблены, чтобы мерить сам бот,
+а не троттлинг; --production-limits оставляет их как в проде.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+MAIN = os.path.join(os.path.dirname(HERE), "main.py")
+
+from fake_perplexity import FakePerplexity  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+ADMIN_ID = 1
+CHATTER = ["привет", "как дела", "кто идет в кино", "скинь домашку по алгебре", "лол", "ок, понял",
+           "завтра контрольная?", "👍", "а где собираемся", "я опоздаю минут на десять"]
+QUESTIONS = ["сколько будет {n} в квадрате", "кто написал Войну и мир", "реши уравнение x + {n} = 2{n}",
+             "почему небо голубое", "что такое фотосинтез", "столица страны номер {n}"]
+
+RELAXED_LIMITS = {
+    "TG_GLOBAL_RATE": "1000",
+    "TG_GROUP_RATE_PER_MIN": "60000",
+    "TG_GROUP_BURST": "200",
+    "TG_GROUP_EDIT_RATE_PER_MIN": "60000",
+    "TG_GROUP_EDIT_BURST": "200",
+    "TG_PRIVATE_RATE": "100",
+    "TG_PRIVATE_BURST": "100",
+    "LLM_USER_RATE_PER_MIN": "6000",
+    "LLM_USER_BURST": "100",
+    "LLM_CHAT_RATE_PER_MIN": "60000",
+    "LLM_CHAT_BURST": "1000",
+    "LLM_QUEUE_SIZE": "1000",
+    "LLM_QUEUE_TIMEOUT": "120",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def free_port_range(count: int) -> int:
+    """Первый из count свободных портов подряд: воркеры бота слушают METRICS_PORT+1+i."""
+    while True:
+        base = free_port()
+        try:
+            for port in range(base + 1, base + count):
+                with socket.socket() as sock:
+                    sock.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+
+
+async def start_app(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+
+def process_tree(pid: int) -> list:
+    """pid и все его потомки (воркеры при BOT_WORKERS > 1)."""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f"/proc/{current}/task/{current}/children", "r") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def read_rss_kb(pid: int, field: str = "VmRSS") -> int:
+    """Сумма по дереву процессов бота."""
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status", "r") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def parse_metrics(text: str) -> list:
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        head, value = line.rsplit(" ", 1)
+        name, _, labels = head.partition("{")
+        samples.append((name, dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels)), float(value)))
+    return samples
+
+
+def histogram_quantile(samples: list, name: str, q: float, **match) -> float:
+    # Бакеты с одинаковой границей от разных процессов складываются
+    counts = defaultdict(float)
+    for n, labels, value in samples:
+        if n == f"{name}_bucket" and all(labels.get(k) == v for k, v in match.items()):
+            counts[float(labels["le"])] += value
+    buckets = sorted(counts.items())
+    if not buckets or not buckets[-1][1]:
+        return None
+    total = buckets[-1][1]
+    return next(le for le, count in buckets if count >= q * total)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.telegram = FakeTelegram(args.telegram_latency)
+        self.perplexity = FakePerplexity(args.llm_latency, args.llm_jitter, args.rate_429, seed=args.seed)
+        self.groups = [-1001000000000 - i for i in range(args.groups)]
+        self.large_group = self.groups[0]
+        self.message_ids = itertools.count(1)
+        # сценарий -> [(chat_id, message_id, время отправки)]
+        self.sent = defaultdict(list)
+        self.injected = 0
+        self.max_lag = 0.0
+        self.peak_rss_kb = 0
+        self.proc = None
+        self.workers = 1
+        self.metrics_port = None
+
+    def user(self, chat_id: int, index: int) -> dict:
+        user_id = (abs(chat_id) % 1000) * 100000 + index + 2
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def random_user(self, chat_id: int) -> dict:
+        users = self.args.large_group_users if chat_id == self.large_group else self.args.users
+        return self.user(chat_id, self.rng.randrange(users))
+
+    def push_message(self, scenario: str, chat_id: int, user: dict, text: str, photo: list = None) -> int:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "loadtest"},
+            "from": user,
+        }
+        if photo:
+            message["photo"] = photo
+            message["caption"] = text
+        else:
+            message["text"] = text
+        self.telegram.push_update({"message": message})
+        self.injected += 1
+        self.sent[scenario].append((chat_id, message["message_id"], time.perf_counter()))
+        return message["message_id"]
+
+    def push_callback(self, scenario: str, chat_id: int, user: dict, data: str):
+        self.telegram.push_update({"callback_query": {
+            "id": str(self.telegram.next_message_id()),
+            "from": user,
+            "chat_instance": "loadtest",
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "text": "Игра МАФИЯ",
+                        "chat": {"id": chat_id, "type": "supergroup", "title": "loadtest"}},
+        }})
+        self.injected += 1
+        self.sent[scenario].append((chat_id, None, time.perf_counter()))
+
+    def question(self) -> str:
+        return self.rng.choice(QUESTIONS).format(n=self.rng.randrange(1000))
+
+    def photo_sizes(self) -> list:
+        unique = f"photo{self.telegram.next_message_id()}"
+        return [
+            {"file_id": f"{unique}_s", "file_unique_id": f"{unique}_s", "width": 320, "height": 240, "file_size": 20000},
+            {"file_id": unique, "file_unique_id": unique, "width": 1280, "height": 960,
+             "file_size": len(self.telegram.photo)},
+        ]
+
+    async def poisson(self, rate: float, action):
+        if rate <= 0:
+            return
+        deadline = time.perf_counter() + self.args.duration
+        while True:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            if time.perf_counter() >= deadline:
+                return
+            action()
+
+    async def periodic(self, every: float, action):
+        if every <= 0:
+            return
+        deadline = time.perf_counter() + self.args.duration
+        while time.perf_counter() + every < deadline:
+            await asyncio.sleep(every)
+            action()
+
+    def chatter(self):
+        chat_id = self.rng.choice(self.groups)
+        self.push_message("chatter", chat_id, self.random_user(chat_id), self.rng.choice(CHATTER))
+
+    def ask(self):
+        chat_id = self.rng.choice(self.groups)
+        prefix = self.rng.choice(("/ask ", "улитка, "))
+        self.push_message("ask", chat_id, self.random_user(chat_id), prefix + self.question())
+
+    def ask_burst(self):
+        # Половина всплеска - один и тот же вопрос: проверяет склейку одинаковых запросов
+        chat_id = self.rng.choice(self.groups)
+        same = self.question()
+        for i in range(self.args.burst_size):
+            text = same if i % 2 else self.question()
+            self.push_message("ask", chat_id, self.random_user(chat_id), "/ask " + text)
+
+    def photo(self):
+        chat_id = self.rng.choice(self.groups)
+        self.push_message("photo", chat_id, self.random_user(chat_id), "/ask что на фото?", self.photo_sizes())
+
+    def tag_all(self):
+        self.push_message("all", self.large_group, self.random_user(self.large_group), "/all")
+
+    async def mafia(self, chat_id: int):
+        deadline = time.perf_counter() + self.args.duration
+        host = self.user(chat_id, 0)
+        self.push_message("mafia_create", chat_id, host, "/mafia")
+        await asyncio.sleep(0.5)
+        for i in range(self.args.mafia_players):
+            self.push_callback("mafia_join", chat_id, self.user(chat_id, i), "mafia_join")
+        await asyncio.sleep(1.0)
+        self.push_callback("mafia_start", chat_id, host, "mafia_start")
+        await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+        self.push_message("mafia_stop", chat_id, host, "/mafia_stop")
+
+    async def warm_up(self):
+        """Каждый участник большой группы пишет по сообщению, чтобы /all было кого звать."""
+        started = time.perf_counter()
+        for i in range(self.args.large_group_users):
+            self.push_message("warmup", self.large_group, self.user(self.large_group, i), "всем привет")
+        for chat_id in self.groups[1:]:
+            for i in range(self.args.users):
+                self.push_message("warmup", chat_id, self.user(chat_id, i), "всем привет")
+        while self.telegram.pending:
+            await asyncio.sleep(0.05)
+        return time.perf_counter() - started
+
+    async def start_bot(self, tmp: str):
+        env = dict(os.environ)
+        env.update({
+            "BOT_TOKEN": "123456:LOADTEST",
+            "PERPLEXITY_API_KEY": "loadtest",
+            "ADMIN_ID": str(ADMIN_ID),
+            "ALLOWED_CHAT_ID": ",".join(map(str, self.groups)),
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{self.telegram_port}",
+            "PERPLEXITY_API_URL": f"http://127.0.0.1:{self.perplexity_port}/chat/completions",
+            "USERS_DB_PATH": os.path.join(tmp, "bot.db"),
+            "STATE_DB_PATH": os.path.join(tmp, "state.db"),
+            "ANSWER_CACHE_FILE": os.path.join(tmp, "answer_cache.json"),
+            "MAFIA_NIGHT_SECONDS": "3",
+            "MAFIA_DAY_SECONDS": "3",
+            "MAFIA_VOTE_SECONDS": "3",
+            "PYTHONUNBUFFERED": "1",
+        })
+        if not self.args.production_limits:
+            env.update(RELAXED_LIMITS)
+        for item in self.args.bot_env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        self.workers = max(1, int(env.get("BOT_WORKERS", "1")))
+        self.metrics_port = free_port_range(self.workers + 1 if self.workers > 1 else 1)
+        env["METRICS_PORT"] = str(self.metrics_port)
+        self.log_path = os.path.join(tmp, "bot.log")
+        self.log_file = open(self.log_path, "wb")
+        self.proc = await asyncio.create_subprocess_exec(sys.executable, MAIN, env=env,
+                                                         stdout=self.log_file, stderr=asyncio.subprocess.STDOUT)
+        poll = asyncio.ensure_future(self.telegram.first_poll.wait())
+        exited = asyncio.ensure_future(self.proc.wait())
+        await asyncio.wait({poll, exited}, timeout=60, return_when=asyncio.FIRST_COMPLETED)
+        if not poll.done():
+            poll.cancel()
+            exited.cancel()
+            raise RuntimeError(f"Bot did not start polling, see {self.log_path}")
+        exited.cancel()
+
+    async def stop_bot(self):
+        self.peak_rss_kb = max(self.peak_rss_kb, read_rss_kb(self.proc.pid, "VmHWM"))
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(self.proc.wait(), 30)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+        self.log_file.close()
+
+    async def sample(self, session: aiohttp.ClientSession):
+        """Раз в секунду: RSS бота и задержка event loop из его /metrics (худшая по процессам)."""
+        while True:
+            self.peak_rss_kb = max(self.peak_rss_kb, read_rss_kb(self.proc.pid))
+            samples, _ = await self.scrape(session)
+            lags = [v for n, _, v in samples if n == "bot_event_loop_lag_seconds"]
+            self.max_lag = max([self.max_lag, *lags])
+            await asyncio.sleep(1)
+
+    def metrics_ports(self) -> list:
+        if self.workers == 1:
+            return [self.metrics_port]
+        # Ингестор и воркеры: вопросы и задержка loop живут в воркерах
+        return [self.metrics_port + i for i in range(self.workers + 1)]
+
+    async def scrape(self, session: aiohttp.ClientSession) -> tuple:
+        """(метрики всех процессов бота одним списком, сколько процессов ответило).
+
+        Недоступный процесс, например перезапускаемый воркер, пропускается.
+        """
+        samples, scraped = [], 0
+        for port in self.metrics_ports():
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                    samples.extend(parse_metrics(await resp.text()))
+                    scraped += 1
+            except aiohttp.ClientError:
+                pass
+        return samples, scraped
+
+    async def drain(self):
+        """Ждет, пока бот перестанет звонить в API (ответы дописаны), но не дольше --drain."""
+        deadline = time.perf_counter() + self.args.drain
+        last = len(self.telegram.calls)
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(1.0)
+            if len(self.telegram.calls) == last and not self.telegram.pending and not self.perplexity.active:
+                return
+            last = len(self.telegram.calls)
+
+    async def run(self) -> dict:
+        self.telegram_port = free_port()
+        self.perplexity_port = free_port()
+        runners = [await start_app(self.telegram.app(), self.telegram_port),
+                   await start_app(self.perplexity.app(), self.perplexity_port)]
+        with tempfile.TemporaryDirectory(prefix="loadtest-") as tmp:
+            await self.start_bot(tmp)
+            async with aiohttp.ClientSession() as session:
+                sampler = asyncio.ensure_future(self.sample(session))
+                try:
+                    warmup_seconds = await self.warm_up()
+                    started = time.perf_counter()
+                    injected_before = self.injected
+                    calls_before = len(self.telegram.calls)
+                    await asyncio.gather(
+                        self.poisson(self.args.chatter_rate, self.chatter),
+                        self.poisson(self.args.ask_rate, self.ask),
+                        self.poisson(self.args.photo_rate, self.photo),
+                        self.periodic(self.args.burst_every, self.ask_burst),
+                        self.periodic(self.args.all_every, self.tag_all),
+                        *(self.mafia(chat_id) for chat_id in self.groups[1:1 + self.args.mafia_games]),
+                    )
+                    await self.drain()
+                    elapsed = time.perf_counter() - started
+                    bot_metrics, scraped = await self.scrape(session)
+                finally:
+                    sampler.cancel()
+                    await self.stop_bot()
+            if self.args.keep_log:
+                with open(self.log_path, "rb") as src, open(self.args.keep_log, "wb") as dst:
+                    dst.write(src.read())
+        for runner in runners:
+            await runner.cleanup()
+        return self.report(warmup_seconds, elapsed, self.injected - injected_before,
+                           len(self.telegram.calls) - calls_before, bot_metrics, scraped)
+
+    def latencies(self) -> dict:
+        first_reply, last_touch, origin_of = {}, {}, {}
+        chat_messages = defaultdict(list)
+        for t, method, params, result in self.telegram.calls:
+            if method == "sendMessage":
+                chat_id = int(params["chat_id"])
+                chat_messages[chat_id].append((t, params.get("text", "")))
+                reply_to = params.get("reply_to_message_id")
+                if reply_to:
+                    origin = (chat_id, int(reply_to))
+                    first_reply.setdefault(origin, t)
+                    last_touch[origin] = t
+                    origin_of[(chat_id, result["message_id"])] = origin
+            elif method == "editMessageText":
+                origin = origin_of.get((int(params["chat_id"]), int(params["message_id"])))
+                if origin:
+                    last_touch[origin] = t
+
+        result = {}
+        for scenario in ("ask", "photo"):
+            sent = self.sent[scenario]
+            result[f"{scenario} first reply"] = ([first_reply[(c, m)] - t for c, m, t in sent if (c, m) in first_reply], len(sent))
+            result[f"{scenario} complete"] = ([last_touch[(c, m)] - t for c, m, t in sent if (c, m) in last_touch], len(sent))
+
+        def first_after(scenario: str, chat_texts, predicate) -> tuple:
+            values = []
+            for chat_id, _, t in self.sent[scenario]:
+                found = next((mt for mt, text in chat_texts(chat_id) if mt >= t and predicate(text)), None)
+                if found is not None:
+                    values.append(found - t)
+            return values, len(self.sent[scenario])
+
+        result["all"] = first_after("all", chat_messages.__getitem__, lambda text: text.startswith("Общий сбор"))
+        result["mafia start"] = first_after("mafia_start", chat_messages.__getitem__,
+                                            lambda text: text.startswith("Игра началась"))
+
+        # Последняя личка с ролью после старта партии: сколько занимает рассылка ролей
+        role_times = [t for t, method, params, _ in self.telegram.calls
+                      if method == "sendMessage" and params.get("text", "").startswith("Ваша роль")]
+        values = []
+        for _, _, t in self.sent["mafia_start"]:
+            after = [rt for rt in role_times if rt >= t]
+            if len(after) >= self.args.mafia_players:
+                values.append(sorted(after)[self.args.mafia_players - 1] - t)
+        result["mafia roles sent"] = (values, len(self.sent["mafia_start"]))
+        return result
+
+    def report(self, warmup_seconds: float, elapsed: float, injected: int, calls: int, bot_metrics: list,
+               scraped: int) -> dict:
+        scenarios = {}
+        print(f"{'scenario':<20} {'count':>6} {'lost':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, (values, count) in self.latencies().items():
+            if not count:
+                continue
+            stats = {"count": count, "lost": count - len(values)}
+            if values:
+                stats.update(p50=percentile(values, 0.5) * 1000, p95=percentile(values, 0.95) * 1000,
+                             p99=percentile(values, 0.99) * 1000)
+                print(f"{name:<20} {count:>6} {stats['lost']:>5} {stats['p50']:>9.0f} {stats['p95']:>9.0f} {stats['p99']:>9.0f}")
+            else:
+                print(f"{name:<20} {count:>6} {stats['lost']:>5} {'-':>9} {'-':>9} {'-':>9}")
+            scenarios[name] = stats
+
+        ask_outcomes = defaultdict(int)
+        for name, labels, value in bot_metrics:
+            if name == "bot_ask_seconds_count":
+                ask_outcomes[labels["outcome"]] += int(value)
+        ask_outcomes = dict(ask_outcomes)
+        update_p50 = histogram_quantile(bot_metrics, "bot_update_seconds", 0.5, type="message")
+        update_p95 = histogram_quantile(bot_metrics, "bot_update_seconds", 0.95, type="message")
+        summary = {
+            "scenarios": scenarios,
+            "warmup_seconds": warmup_seconds,
+            "updates_per_second": injected / elapsed,
+            "bot_api_calls_per_second": calls / elapsed,
+            "perplexity_requests": self.perplexity.requests,
+            "perplexity_429": self.perplexity.throttled,
+            "perplexity_peak_concurrency": self.perplexity.peak_active,
+            "ask_outcomes": ask_outcomes,
+            "update_handling_p50_ms": update_p50 * 1000 if update_p50 is not None else None,
+            "update_handling_p95_ms": update_p95 * 1000 if update_p95 is not None else None,
+            "max_event_loop_lag_ms": self.max_lag * 1000,
+            "peak_rss_mb": self.peak_rss_kb / 1024,
+            "metrics_processes": f"{scraped}/{len(self.metrics_ports())}",
+        }
+        print()
+        print(f"warm-up: {self.args.large_group_users + self.args.users * (self.args.groups - 1)} messages "
+              f"delivered in {warmup_seconds:.2f}s")
+        print(f"load: {injected} updates in {elapsed:.1f}s ({summary['updates_per_second']:.1f}/s), "
+              f"{calls} Bot API calls ({summary['bot_api_calls_per_second']:.1f}/s)")
+        print(f"perplexity: {self.perplexity.requests} requests, {self.perplexity.throttled} answered 429, "
+              f"peak concurrency {self.perplexity.peak_active}")
+        if scraped < len(self.metrics_ports()):
+            print(f"WARNING: bot metrics scraped from {scraped} of {len(self.metrics_ports())} processes, "
+                  f"outcomes and lag below are incomplete")
+        print(f"ask outcomes (bot metrics): {ask_outcomes}")
+        if update_p50 is not None:
+            print(f"update handling (bot metrics, bucket bound): p50 <= {update_p50 * 1000:.0f} ms, "
+                  f"p95 <= {update_p95 * 1000:.0f} ms")
+        print(f"max event loop lag: {self.max_lag * 1000:.1f} ms")
+        print(f"peak RSS: {summary['peak_rss_mb']:.1f} MB")
+        return summary
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, stats in summary["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base and "p95" in base and "p95" in stats and stats["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95']:.0f} -> {stats['p95']:.0f} ms")
+        if base and stats["lost"] > base["lost"]:
+            regressions.append(f"{name}: lost {base['lost']} -> {stats['lost']}")
+    if baseline.get("peak_rss_mb") and summary["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak RSS {baseline['peak_rss_mb']:.1f} -> {summary['peak_rss_mb']:.1f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--drain", type=float, default=30, help="max seconds to wait for answers after the load")
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--users", type=int, default=50, help="members in each regular group")
+    parser.add_argument("--large-group-users", type=int, default=1000)
+    parser.add_argument("--chatter-rate", type=float, default=50, help="plain messages per second")
+    parser.add_argument("--ask-rate", type=float, default=2, help="/ask per second")
+    parser.add_argument("--burst-every", type=float, default=10)
+    parser.add_argument("--burst-size", type=int, default=10)
+    parser.add_argument("--photo-rate", type=float, default=0.3)
+    parser.add_argument("--all-every", type=float, default=15)
+    parser.add_argument("--mafia-games", type=int, default=2)
+    parser.add_argument("--mafia-players", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--llm-jitter", type=float, default=0.5)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--production-limits", action="store_true")
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the summary as JSON")
+    parser.add_argument("--baseline", help="compare with a saved summary")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--keep-log", help="copy the bot log here")
+    args = parser.parse_args()
+    args.mafia_games = min(args.mafia_games, args.groups - 1)
+
+    summary = asyncio.run(LoadTest(args).run())
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,103 +1,2566 @@
 import logging
 import aiohttp
+import aiosqlite
+from aiohttp import web
 import json
 import os
 import re
 import asyncio
 import base64
+import bisect
+import contextvars
+import email.utils
+import functools
+import hashlib
+import heapq
+import hmac
+import html
+import io
+import itertools
+import multiprocessing
 import random
+import signal
+import socket
+import time
+import urllib.parse
+import zlib
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
+
+try:
+    ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+    allowed_chats_str = os.getenv("ALLOWED_CHAT_ID", "0")
+    ALLOWED_CHAT_IDS = [int(x.strip()) for x in allowed_chats_str.split(",") if x.strip()]
+    
+    if not ALLOWED_CHAT_IDS or ALLOWED_CHAT_IDS == [0]:
+        logging.error("ALLOWED_CHAT_ID не настроен!")
+        exit(1)
+except ValueError:
+    logging.error("ADMIN_ID или ALLOWED_CHAT_ID должны быть числами!")
+    exit(1)
+
+# Другие адреса API нужны для локального Bot API сервера и нагрузочных тестов (loadtest/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+PERPLEXITY_API_URL = os.getenv("PERPLEXITY_API_URL", "https://api.perplexity.ai/chat/completions")
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))
+
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_GROUP_RATE_PER_MIN = float(os.getenv("TG_GROUP_RATE_PER_MIN", "20"))
+TG_GROUP_BURST = float(os.getenv("TG_GROUP_BURST", "5"))
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", "1"))
+TG_PRIVATE_BURST = float(os.getenv("TG_PRIVATE_BURST", "3"))
+# Правки сообщений считаются отдельно от отправок: все потоковые ответы чата делят один лимит
+TG_GROUP_EDIT_RATE_PER_MIN = float(os.getenv("TG_GROUP_EDIT_RATE_PER_MIN", "20"))
+TG_GROUP_EDIT_BURST = float(os.getenv("TG_GROUP_EDIT_BURST", "3"))
+
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", "3.0"))
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "20"))
+
+PHOTO_TARGET_SIDE = int(os.getenv("PHOTO_TARGET_SIDE", "1280"))
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1600"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "85"))
+PHOTO_MAX_BYTES = 20 * 1024 * 1024
+PHOTO_CACHE_BYTES = int(os.getenv("PHOTO_CACHE_MB", "32")) * 1024 * 1024
+
+SEARCH_RECENCY_FILTER = os.getenv("SEARCH_RECENCY_FILTER", "month")
+RECENCY_SECONDS = {"hour": 3600, "day": 86400, "week": 7 * 86400, "month": 30 * 86400, "year": 365 * 86400}
+# По умолчанию ответ живет 1/24 окна поиска: для "month" это чуть больше суток
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", RECENCY_SECONDS.get(SEARCH_RECENCY_FILTER, 86400) / 24))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2000"))
+ANSWER_CACHE_FILE = os.getenv("ANSWER_CACHE_FILE", "/data/answer_cache.json")
+ANSWER_CACHE_SAVE_INTERVAL = float(os.getenv("ANSWER_CACHE_SAVE_INTERVAL", "300"))
+
+# Контекст из цепочки ответов: память ограничена числом чатов, кольцом сообщений на чат и длиной сообщения
+CONTEXT_CHATS = int(os.getenv("CONTEXT_CHATS", "300"))
+CONTEXT_MESSAGES_PER_CHAT = int(os.getenv("CONTEXT_MESSAGES_PER_CHAT", "32"))
+CONTEXT_MESSAGE_CHARS = int(os.getenv("CONTEXT_MESSAGE_CHARS", "1500"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_MAX_DEPTH = int(os.getenv("CONTEXT_MAX_DEPTH", "8"))
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "20"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_USER_RATE = float(os.getenv("LLM_USER_RATE_PER_MIN", "6")) / 60
+LLM_USER_BURST = float(os.getenv("LLM_USER_BURST", "3"))
+LLM_CHAT_RATE = float(os.getenv("LLM_CHAT_RATE_PER_MIN", "30")) / 60
+LLM_CHAT_BURST = float(os.getenv("LLM_CHAT_BURST", "10"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "2"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+# Вместо одного общего таймаута: на соединение и на ожидание первого байта (и пауз в потоке)
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_FIRST_BYTE_TIMEOUT = float(os.getenv("LLM_FIRST_BYTE_TIMEOUT", "25"))
+# Пустая модель - дубль уходит в ту же модель. Для фото дубль всегда в ту же модель
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "8"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))
+LLM_HEDGE_BURST = float(os.getenv("LLM_HEDGE_BURST", "3"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_LATENCY_MIN_SAMPLES = int(os.getenv("LLM_LATENCY_MIN_SAMPLES", "20"))
+LLM_HEALTH_WINDOW = float(os.getenv("LLM_HEALTH_WINDOW", "120"))
+LLM_MODEL_MAX_ERROR_RATE = float(os.getenv("LLM_MODEL_MAX_ERROR_RATE", "0.5"))
+# max_tokens по типу вопроса вместо одного лимита на все
+LLM_MAX_TOKENS_GREETING = int(os.getenv("LLM_MAX_TOKENS_GREETING", "150"))
+LLM_MAX_TOKENS_GENERAL = int(os.getenv("LLM_MAX_TOKENS_GENERAL", "800"))
+LLM_MAX_TOKENS_SCHOOL = int(os.getenv("LLM_MAX_TOKENS_SCHOOL", "1500"))
+LLM_MAX_TOKENS_PHOTO = int(os.getenv("LLM_MAX_TOKENS_PHOTO", "2000"))
+
+# Учет расхода: цены в $ за 1M токенов "модель=вход:выход", дневные бюджеты в $ (0 - без лимита), сутки по UTC
+USAGE_PRICES = os.getenv("USAGE_PRICES", "sonar=1:1,sonar-pro=3:15")
+USAGE_CHAT_DAILY_USD = float(os.getenv("USAGE_CHAT_DAILY_USD", "0"))
+USAGE_USER_DAILY_USD = float(os.getenv("USAGE_USER_DAILY_USD", "0"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+
+DB_FILE = "/data/users_db.json"
+NICKNAMES_FILE = "/data/nicks.json"
+USERS_DB_PATH = os.getenv("USERS_DB_PATH", "/data/bot.db")
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "2.0"))
+USER_FLUSH_BATCH = int(os.getenv("USER_FLUSH_BATCH", "200"))
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "/data/state.db")
+STATE_KV_URL = os.getenv("STATE_KV_URL", "redis://127.0.0.1:6380/0")
+STATE_CACHED_GAMES = int(os.getenv("STATE_CACHED_GAMES", "256"))
+# Только для STATE_BACKEND=kv: повторы при конфликте записи игры и срок аренды таймеров фаз
+STATE_CONFLICT_RETRIES = int(os.getenv("STATE_CONFLICT_RETRIES", "5"))
+STATE_TIMER_LEASE = float(os.getenv("STATE_TIMER_LEASE", "15"))
+
+MAFIA_DM_CONCURRENCY = int(os.getenv("MAFIA_DM_CONCURRENCY", "10"))
+MAFIA_NIGHT_SECONDS = float(os.getenv("MAFIA_NIGHT_SECONDS", "60"))
+MAFIA_DAY_SECONDS = float(os.getenv("MAFIA_DAY_SECONDS", "90"))
+MAFIA_VOTE_SECONDS = float(os.getenv("MAFIA_VOTE_SECONDS", "45"))
+# Игра без ходов и голосов иначе крутится по таймерам бесконечно (0 - без ограничения)
+MAFIA_IDLE_ROUNDS = int(os.getenv("MAFIA_IDLE_ROUNDS", "2"))
+MAFIA_MAX_DAYS = int(os.getenv("MAFIA_MAX_DAYS", "30"))
+
+# BOT_WORKERS > 1: этот процесс только принимает апдейты и раздает их воркерам по chat_id
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+BOT_WORKER_INDEX = int(os.getenv("BOT_WORKER_INDEX", "-1"))
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv("WORKER_HEARTBEAT_TIMEOUT", "30"))
+WORKER_CHECK_INTERVAL = float(os.getenv("WORKER_CHECK_INTERVAL", "2"))
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "40"))
+
+if BOT_WORKER_INDEX >= 0:
+    # Воркер делит общие лимиты с остальными и пишет в свои файлы
+    TG_GLOBAL_RATE /= BOT_WORKERS
+    LLM_MAX_CONCURRENCY = max(1, LLM_MAX_CONCURRENCY // BOT_WORKERS)
+    if METRICS_PORT:
+        METRICS_PORT += 1 + BOT_WORKER_INDEX
+    if ANSWER_CACHE_FILE:
+        ANSWER_CACHE_FILE = f"{ANSWER_CACHE_FILE}.{BOT_WORKER_INDEX}"
+
+if not BOT_TOKEN or not PERPLEXITY_API_KEY:
+    logging.error("ОШИБКА: Не найдены BOT_TOKEN или PERPLEXITY_API_KEY в переменных окружения!")
+    exit(1)
+
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    logging.error("Для BOT_MODE=webhook нужен WEBHOOK_URL!")
+    exit(1)
+
+try:
+    USAGE_PRICE_TABLE = {}
+    for item in USAGE_PRICES.split(","):
+        if item.strip():
+            price_model, _, price = item.strip().partition("=")
+            price_in, _, price_out = price.partition(":")
+            USAGE_PRICE_TABLE[price_model] = (float(price_in), float(price_out or price_in))
+except ValueError:
+    logging.error("USAGE_PRICES должен быть вида sonar=1:1,sonar-pro=3:15!")
+    exit(1)
+
+if BOT_WORKERS < 1:
+    logging.error("BOT_WORKERS должен быть не меньше 1!")
+    exit(1)
+
+if STATE_BACKEND not in ("memory", "sqlite", "kv"):
+    logging.error("STATE_BACKEND должен быть memory, sqlite или kv!")
+    exit(1)
+
+# Id апдейта, который сейчас обрабатывается, попадает в каждую строку лога
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+_make_log_record = logging.getLogRecordFactory()
+
+def _log_record_with_trace(*args, **kwargs):
+    record = _make_log_record(*args, **kwargs)
+    record.trace_id = trace_id_var.get()
+    return record
+
+logging.setLogRecordFactory(_log_record_with_trace)
+if BOT_WORKERS > 1:
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(processName)s:%(name)s:%(trace_id)s:%(message)s")
+else:
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(trace_id)s:%(message)s")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), func=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.func = func
+        self.values = {}
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.func is not None:
+            yield f"{self.name} {self.func()}"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [счетчики по корзинам + корзина +Inf, сумма]
+        self.series = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels):
+        return HistogramTimer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+class HistogramTimer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+class NullMetric:
+    """Заглушка, когда /metrics выключен: вызовы ничего не делают."""
+
+    _timer = nullcontext()
+
+    def inc(self, *labels, amount: float = 1.0):
+        pass
+
+    def set(self, value: float, *labels):
+        pass
+
+    def observe(self, value: float, *labels):
+        pass
+
+    def time(self, *labels):
+        return self._timer
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.metrics = []
+        self.null = NullMetric()
+
+    def counter(self, name: str, doc: str, labels: tuple = ()):
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, labels: tuple = (), func=None):
+        return self._add(Gauge(name, doc, labels, func))
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def _add(self, metric):
+        if not self.enabled:
+            return self.null
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(METRICS_PORT > 0)
+ASK_SECONDS = metrics.histogram("bot_ask_seconds", "ask_perplexity latency including cache, queue and upstream", ("model", "outcome"))
+PERPLEXITY_SECONDS = metrics.histogram("bot_perplexity_request_seconds", "Perplexity request latency with retries, without admission queue", ("model", "outcome"))
+PERPLEXITY_ERRORS = metrics.counter("bot_perplexity_errors_total", "Failed Perplexity attempts by reason", ("reason",))
+PERPLEXITY_RETRIES = metrics.counter("bot_perplexity_retries_total", "Perplexity attempts that were retried", ("reason",))
+PERPLEXITY_FIRST_BYTE = metrics.histogram("bot_perplexity_first_byte_seconds", "Time to Perplexity response headers", ("model",))
+LLM_TOKENS = metrics.counter("bot_llm_tokens_total", "Tokens reported by Perplexity usage", ("model", "kind"))
+PERPLEXITY_HEDGES = metrics.counter("bot_perplexity_hedges_total", "Hedged duplicate requests by which attempt answered first", ("model", "result"))
+COMMAND_SECONDS = metrics.histogram("bot_command_seconds", "Routed command handler duration", ("command",))
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "aiogram handler duration", ("handler",))
+UPDATE_SECONDS = metrics.histogram("bot_update_seconds", "Whole update processing time", ("type",))
+PHOTO_SECONDS = metrics.histogram("bot_photo_download_seconds", "Photo download and encode time")
+PHOTO_BYTES = metrics.histogram("bot_photo_download_bytes", "Downloaded photo size", buckets=SIZE_BUCKETS)
+SEND_SECONDS = metrics.histogram("bot_send_seconds", "Outgoing Telegram call latency including outbox queueing", ("method",))
+EVENT_LOOP_LAG = metrics.gauge("bot_event_loop_lag_seconds", "How late a periodic event loop wakeup was")
+WORKER_UPDATES = metrics.counter("bot_worker_updates_total", "Updates handed to each worker process", ("worker",))
+WORKER_RESTARTS = metrics.counter("bot_worker_restarts_total", "Worker processes restarted after a crash or a missed heartbeat", ("worker",))
+metrics.gauge("bot_llm_queue_waiting", "Requests waiting for an LLM slot", func=lambda: admission.waiting)
+metrics.gauge("bot_llm_inflight", "Distinct Perplexity requests in flight", func=lambda: len(inflight_requests))
+metrics.gauge("bot_outbox_queued", "Telegram calls waiting in the outbox", func=lambda: sum(map(len, outbox.queues.values())))
+metrics.gauge("bot_updates_inflight", "Webhook updates being processed", func=lambda: len(inflight_updates))
+metrics.gauge("bot_context_bytes", "Compressed reply-chain context held in memory", func=lambda: conversations.stats()["bytes"])
+
+class TraceMiddleware(BaseMiddleware):
+    """Ставит trace id апдейта в контекст логов и меряет время обработки."""
+
+    UPDATE_TYPES = ("message", "callback_query", "edited_message", "my_chat_member", "chat_member")
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        trace_id_var.set(f"u{update.update_id}")
+        data["trace_started"] = time.perf_counter()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        kind = next((k for k in self.UPDATE_TYPES if getattr(update, k) is not None), "other")
+        UPDATE_SECONDS.observe(time.perf_counter() - data["trace_started"], kind)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start_handler(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finish_handler(data)
+
+    async def on_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        self._start_handler(data)
+
+    async def on_post_process_callback_query(self, callback: types.CallbackQuery, results, data: dict):
+        self._finish_handler(data)
+
+    @staticmethod
+    def _start_handler(data: dict):
+        data["handler_name"] = current_handler.get().__name__
+        data["handler_started"] = time.perf_counter()
+
+    @staticmethod
+    def _finish_handler(data: dict):
+        if "handler_started" in data:
+            HANDLER_SECONDS.observe(time.perf_counter() - data["handler_started"], data["handler_name"])
+
+async def monitor_event_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.set(max(0.0, time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL))
+
+async def serve_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+class StateBackendError(Exception):
+    pass
+
+class StateBackend:
+    """Ключ-значение для состояния игр и FSM. Значения - bytes."""
+
+    # shared: состояние могут менять другие процессы, локальной копии верить нельзя
+    shared = False
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get(self, key: str):
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes):
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def scan(self, prefix: str) -> list:
+        raise NotImplementedError
+
+    async def compare_and_set(self, key: str, expected, value, ttl: float = None) -> bool:
+        """Записывает value (None - удаляет ключ), только если сейчас там expected.
+
+        Атомарно только внутри одного процесса; общий бэкенд переопределяет.
+        ttl учитывают только бэкенды, которые умеют срок жизни ключа.
+        """
+        if await self.get(key) != expected:
+            return False
+        if value is None:
+            await self.delete(key)
+        else:
+            await self.set(key, value)
+        return True
+
+class MemoryBackend(StateBackend):
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key: str):
+        return self.data.get(key)
+
+    async def set(self, key: str, value: bytes):
+        self.data[key] = value
+
+    async def delete(self, key: str):
+        self.data.pop(key, None)
+
+    async def scan(self, prefix: str) -> list:
+        return [key for key in self.data if key.startswith(prefix)]
+
+class SqliteBackend(StateBackend):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+
+    async def open(self):
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("PRAGMA synchronous=NORMAL")
+        await self.db.executescript(self.SCHEMA)
+        await self.db.commit()
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    async def get(self, key: str):
+        async with self.db.execute("SELECT value FROM kv WHERE key = ?", (key,)) as cur:
+            row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def set(self, key: str, value: bytes):
+        await self.db.execute(
+            "INSERT OR REPLACE INTO kv (key, value, updated_at) VALUES (?, ?, ?)",
+            (key, value, int(time.time())),
+        )
+        await self.db.commit()
+
+    async def delete(self, key: str):
+        await self.db.execute("DELETE FROM kv WHERE key = ?", (key,))
+        await self.db.commit()
+
+    async def scan(self, prefix: str) -> list:
+        async with self.db.execute("SELECT key FROM kv WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff")) as cur:
+            return [row[0] for row in await cur.fetchall()]
+
+class KVBackend(StateBackend):
+    """Клиент общего key-value сервера по протоколу RESP (Redis или kvserver.py)."""
+
+    shared = True
+
+    def __init__(self, url: str):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.strip("/") or 0)
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def open(self):
+        async with self.lock:
+            await self._connect()
+
+    async def close(self):
+        async with self.lock:
+            self._disconnect()
+
+    async def get(self, key: str):
+        return await self.command("GET", key)
+
+    async def set(self, key: str, value: bytes):
+        await self.command("SET", key, value)
+
+    async def delete(self, key: str):
+        await self.command("DEL", key)
+
+    async def scan(self, prefix: str) -> list:
+        keys, cursor = [], b"0"
+        while True:
+            cursor, batch = await self.command("SCAN", cursor, "MATCH", prefix + "*", "COUNT", "500")
+            keys.extend(key.decode() for key in batch)
+            if cursor == b"0":
+                return keys
+
+    async def compare_and_set(self, key: str, expected, value, ttl: float = None) -> bool:
+        if isinstance(expected, str):
+            expected = expected.encode()
+        if value is None:
+            write = ("DEL", key)
+        elif ttl:
+            write = ("SET", key, value, "PX", str(int(ttl * 1000)))
+        else:
+            write = ("SET", key, value)
+
+        async def transaction():
+            # EXEC вернет nil, если ключ изменили после WATCH
+            await self._roundtrip(("WATCH", key))
+            if await self._roundtrip(("GET", key)) != expected:
+                await self._roundtrip(("UNWATCH",))
+                return False
+            await self._roundtrip(("MULTI",))
+            await self._roundtrip(write)
+            return await self._roundtrip(("EXEC",)) is not None
+
+        return await self._locked(transaction)
+
+    async def command(self, *args):
+        return await self._locked(lambda: self._roundtrip(args))
+
+    async def _locked(self, operation):
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.writer is None:
+                        await self._connect()
+                    return await operation()
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    self._disconnect()
+                    if attempt:
+                        raise StateBackendError(f"KV server {self.host}:{self.port} unavailable: {e}")
+                except (StateBackendError, asyncio.CancelledError):
+                    # Ответ не дочитан или транзакция не закрыта: соединение дальше не годится
+                    self._disconnect()
+                    raise
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip(("AUTH", self.password))
+        if self.db:
+            await self._roundtrip(("SELECT", str(self.db)))
+
+    def _disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _roundtrip(self, args):
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.writer.write(b"".join(out))
+        await self.writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        line = await self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise StateBackendError(rest.decode(errors="replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            return (await self.reader.readexactly(size + 2))[:-2]
+        if kind == b"*":
+            size = int(rest)
+            if size < 0:
+                return None
+            return [await self._read_reply() for _ in range(size)]
+        raise StateBackendError(f"Unexpected reply: {line!r}")
+
+def create_state_backend() -> StateBackend:
+    if STATE_BACKEND == "memory":
+        return MemoryBackend()
+    if STATE_BACKEND == "kv":
+        return KVBackend(STATE_KV_URL)
+    return SqliteBackend(STATE_DB_PATH)
+
+class BackendStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх StateBackend: одна запись на пару (chat, user)."""
+
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+
+    def key(self, chat, user) -> str:
+        chat, user = self.check_address(chat=chat, user=user)
+        return f"fsm:{chat}:{user}"
+
+    async def load(self, chat, user) -> dict:
+        data = await self.backend.get(self.key(chat, user))
+        return json.loads(data) if data else {}
+
+    async def store(self, chat, user, record: dict):
+        record = {k: v for k, v in record.items() if v}
+        if record:
+            await self.backend.set(self.key(chat, user), json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode())
+        else:
+            await self.backend.delete(self.key(chat, user))
+
+    async def close(self):
+        await self.backend.close()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        record = await self.load(chat, user)
+        return record.get("s", self.resolve_state(default))
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> dict:
+        record = await self.load(chat, user)
+        return record.get("d", default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        record = await self.load(chat, user)
+        record["s"] = self.resolve_state(state)
+        await self.store(chat, user, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        record = await self.load(chat, user)
+        record["d"] = data or {}
+        await self.store(chat, user, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        record = await self.load(chat, user)
+        record.setdefault("d", {}).update(data or {}, **kwargs)
+        await self.store(chat, user, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> dict:
+        record = await self.load(chat, user)
+        return record.get("b", default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        record = await self.load(chat, user)
+        record["b"] = bucket or {}
+        await self.store(chat, user, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        record = await self.load(chat, user)
+        record.setdefault("b", {}).update(bucket or {}, **kwargs)
+        await self.store(chat, user, record)
+
+state_backend = create_state_backend()
+storage = BackendStorage(state_backend)
+bot = Bot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
+dp = Dispatcher(bot, storage=storage)
+dp.middleware.setup(TraceMiddleware())
+http_session: aiohttp.ClientSession = None
+background_tasks = set()
+
+def is_allowed_chat(message: types.Message) -> bool:
+    return message.chat.id in ALLOWED_CHAT_IDS
+
+def start_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_finish_background)
+    return task
+
+def _finish_background(task: asyncio.Task):
+    background_tasks.discard(task)
+    # Иначе упавший фоновый цикл (сохранение кэша, флашеры) молча перестает работать
+    if not task.cancelled() and task.exception():
+        logging.error(f"Background task {task.get_coro().__qualname__} failed", exc_info=task.exception())
+
+class HashRing:
+    """Консистентное хеширование chat_id по воркерам: при смене BOT_WORKERS переезжает мало чатов."""
+
+    def __init__(self, nodes: int, replicas: int = 64):
+        points = sorted((self._hash(f"worker-{node}-{r}"), node) for node in range(nodes) for r in range(replicas))
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def node(self, key: int) -> int:
+        return self.nodes[bisect.bisect(self.points, self._hash(str(key))) % len(self.points)]
+
+shard_ring = HashRing(BOT_WORKERS)
+
+def owns_chat(chat_id: int) -> bool:
+    return BOT_WORKER_INDEX < 0 or shard_ring.node(chat_id) == BOT_WORKER_INDEX
+
+# Игры Мафии
+MAFIA_ROLE_NAMES = {
+    'mafia': 'мафия',
+    'detective': 'детектив',
+    'doctor': 'доктор',
+    'citizen': 'мирный житель'
+}
+
+MAFIA_NIGHT_PROMPTS = {
+    'mafia': 'Ночь {day}. Кого убить?',
+    'detective': 'Ночь {day}. Кого проверить?',
+    'doctor': 'Ночь {day}. Кого спасти?'
+}
+
+MAFIA_ROLE_TEXT = {
+    'mafia': 'Вы МАФИЯ. Убивайте мирных жителей.',
+    'detective': 'Вы ДЕТЕКТИВ. Проверяйте подозрительных.',
+    'doctor': 'Вы ДОКТОР. Спасайте игроков.',
+    'citizen': 'Вы МИРНЫЙ ЖИТЕЛЬ. Ищите мафию.'
+}
+
+class MafiaPlayer:
+    __slots__ = ("id", "name", "role", "alive")
+
+    def __init__(self, user_id: int, name: str, role: str = None, alive: bool = True):
+        self.id = user_id
+        self.name = name
+        self.role = role
+        self.alive = alive
+
+class MafiaGame:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.players = {}
+        self.mafia = set()
+        self.alive = set()
+        self.detective = None
+        self.doctor = None
+        self.phase = "registration"
+        self.day_num = 0
+        self.night_actions = {}
+        self.votes = {}
+        # phase_id меняется на каждом переходе: по нему отбрасываются устаревшие таймеры и кнопки.
+        # Начинается с текущего времени в мс, чтобы новая игра в том же чате не совпала со старой
+        self.phase_id = int(time.time() * 1000)
+        self.deadline = None
+        # Снимок из бэкенда, поверх которого GameStore запишет игру (для общего бэкенда)
+        self.stored = None
+        # Счетчики для проверки победы без обхода списка игроков
+        self.mafia_alive = 0
+        self.citizens_alive = 0
+        # Круги подряд без ходов, голосов и жертв; сбрасывается любым ходом или голосом
+        self.idle_rounds = 0
+        self.night_victim = None
+
+    def add_player(self, user_id: int, name: str) -> bool:
+        if user_id in self.players:
+            return False
+        self.players[user_id] = MafiaPlayer(user_id, name)
+        return True
+
+    def assign_roles(self):
+        order = list(self.players.values())
+        random.shuffle(order)
+        mafia_count = max(1, len(order) // 3)
+        for i, player in enumerate(order):
+            if i < mafia_count:
+                player.role = 'mafia'
+            elif i == mafia_count:
+                player.role = 'detective'
+            elif i == mafia_count + 1:
+                player.role = 'doctor'
+            else:
+                player.role = 'citizen'
+            player.alive = True
+        self._index()
+
+    def kill(self, user_id: int) -> bool:
+        player = self.players.get(user_id)
+        if player is None or not player.alive:
+            return False
+        player.alive = False
+        self.alive.discard(user_id)
+        if user_id in self.mafia:
+            self.mafia_alive -= 1
+        else:
+            self.citizens_alive -= 1
+        return True
+
+    def winner(self):
+        if not self.mafia_alive:
+            return 'citizens'
+        if self.citizens_alive <= self.mafia_alive:
+            return 'mafia'
+        return None
+
+    def alive_players(self) -> list:
+        return [p for p in self.players.values() if p.alive]
+
+    def set_phase(self, phase: str, duration: float = None):
+        self.phase = phase
+        self.phase_id += 1
+        self.deadline = time.time() + duration if duration else None
+
+    def night_actors(self) -> list:
+        return [p for p in self.players.values() if p.alive and p.role in ('mafia', 'detective', 'doctor')]
+
+    def night_targets(self, actor: MafiaPlayer) -> list:
+        if actor.role == 'mafia':
+            return [p for p in self.alive_players() if p.id not in self.mafia]
+        if actor.role == 'detective':
+            return [p for p in self.alive_players() if p.id != actor.id]
+        return self.alive_players()
+
+    def night_done(self) -> bool:
+        return all(p.id in self.night_actions for p in self.night_actors())
+
+    def resolve_night(self):
+        """Жертва мафии - выбор большинства, при равенстве первый выбранный. Доктор может спасти."""
+        tally = {}
+        for actor_id, target_id in self.night_actions.items():
+            if actor_id in self.mafia and actor_id in self.alive:
+                tally[target_id] = tally.get(target_id, 0) + 1
+        saved = self.night_actions.get(self.doctor) if self.doctor in self.alive else None
+        self.night_actions = {}
+        if not tally:
+            return None
+        victim = max(tally, key=tally.get)
+        if victim == saved or not self.kill(victim):
+            return None
+        return self.players[victim]
+
+    def votes_done(self) -> bool:
+        return len(self.votes) >= len(self.alive)
+
+    def resolve_vote(self):
+        """Исключают лидера голосования; при равенстве голосов никого."""
+        tally = {}
+        for voter_id, target_id in self.votes.items():
+            if voter_id in self.alive and target_id in self.alive:
+                tally[target_id] = tally.get(target_id, 0) + 1
+        self.votes = {}
+        if not tally:
+            return None
+        top = max(tally.values())
+        leaders = [target_id for target_id, count in tally.items() if count == top]
+        if len(leaders) > 1 or not self.kill(leaders[0]):
+            return None
+        return self.players[leaders[0]]
+
+    def _index(self):
+        self.mafia = {p.id for p in self.players.values() if p.role == 'mafia'}
+        self.alive = {p.id for p in self.players.values() if p.alive}
+        self.detective = next((p.id for p in self.players.values() if p.role == 'detective'), None)
+        self.doctor = next((p.id for p in self.players.values() if p.role == 'doctor'), None)
+        self.mafia_alive = len(self.mafia & self.alive)
+        self.citizens_alive = len(self.alive) - self.mafia_alive
+
+    def dumps(self) -> bytes:
+        # Множества мафии и живых и счетчики восстанавливаются из игроков
+        state = {
+            "c": self.chat_id,
+            "ph": self.phase,
+            "d": self.day_num,
+            "p": [[p.id, p.name, p.role, p.alive] for p in self.players.values()],
+            "n": list(self.night_actions.items()),
+            "v": list(self.votes.items()),
+            "pi": self.phase_id,
+            "dl": self.deadline,
+            "ir": self.idle_rounds,
+            "nv": self.night_victim,
+        }
+        return json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode()
+
+    @classmethod
+    def loads(cls, data: bytes) -> "MafiaGame":
+        state = json.loads(data)
+        game = cls(state["c"])
+        game.phase = state["ph"]
+        game.day_num = state["d"]
+        game.players = {uid: MafiaPlayer(uid, name, role, alive) for uid, name, role, alive in state["p"]}
+        game.night_actions = {k: v for k, v in state["n"]}
+        game.votes = {k: v for k, v in state.get("v", ())}
+        game.phase_id = state.get("pi", 0)
+        game.deadline = state.get("dl")
+        game.idle_rounds = state.get("ir", 0)
+        game.night_victim = state.get("nv")
+        game._index()
+        return game
+
+class GameConflict(Exception):
+    """Игру изменила другая реплика между чтением и записью."""
+
+class GameStore:
+    """Игры по chat_id: снимок пишется в бэкенд при каждом изменении, в памяти только недавние.
+
+    С общим бэкендом игра читается заново при каждом обращении, а запись идет
+    через compare-and-set поверх прочитанного снимка. Если снимок успели
+    поменять, save и delete бросают GameConflict, и обработчик повторяется.
+    """
+
+    PREFIX = "mafia:"
+
+    def __init__(self, backend: StateBackend, max_cached: int):
+        self.backend = backend
+        self.max_cached = max_cached
+        self.active = OrderedDict()
+        self.locks = {}
+
+    def key(self, chat_id: int) -> str:
+        return f"{self.PREFIX}{chat_id}"
+
+    async def get(self, chat_id: int):
+        game = self.active.get(chat_id)
+        if game is not None and not self.backend.shared:
+            self.active.move_to_end(chat_id)
+            return game
+        # Параллельные апдейты одного чата не должны поднять две разные копии игры
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            game = self.active.get(chat_id)
+            if game is not None and not self.backend.shared:
+                return game
+            data = await self.backend.get(self.key(chat_id))
+            if data is None:
+                self.active.pop(chat_id, None)
+                return None
+            game = MafiaGame.loads(data)
+            game.stored = data
+            self._remember(game)
+            return game
+
+    async def save(self, game: MafiaGame):
+        data = game.dumps()
+        if self.backend.shared:
+            await self._replace(game, data)
+            return
+        self._remember(game)
+        await self.backend.set(self.key(game.chat_id), data)
+
+    async def delete(self, game: MafiaGame):
+        self.active.pop(game.chat_id, None)
+        if self.backend.shared:
+            await self._replace(game, None)
+            return
+        await self.backend.delete(self.key(game.chat_id))
+
+    async def _replace(self, game: MafiaGame, data):
+        if not await self.backend.compare_and_set(self.key(game.chat_id), game.stored, data):
+            self.active.pop(game.chat_id, None)
+            raise GameConflict(game.chat_id)
+        game.stored = data
+        if data is not None:
+            self._remember(game)
+
+    async def chat_ids(self) -> list:
+        return [int(key[len(self.PREFIX):]) for key in await self.backend.scan(self.PREFIX)]
+
+    async def deadlines(self) -> list:
+        """(chat_id, deadline, phase_id) всех игр с таймером, без загрузки игр в память."""
+        result = []
+        for chat_id in await self.chat_ids():
+            data = await self.backend.get(self.key(chat_id))
+            if data:
+                game = MafiaGame.loads(data)
+                if game.deadline:
+                    result.append((chat_id, game.deadline, game.phase_id))
+        return result
+
+    def _remember(self, game: MafiaGame):
+        self.active[game.chat_id] = game
+        self.active.move_to_end(game.chat_id)
+        while len(self.active) > self.max_cached:
+            self.active.popitem(last=False)
+
+mafia_games = GameStore(state_backend, STATE_CACHED_GAMES)
+
+class PhaseScheduler:
+    """Дедлайны фаз всех игр в одной куче и одной задаче.
+
+    Запись (deadline, chat_id, phase_id) не удаляется при досрочном переходе:
+    когда она сработает, phase_id игры уже другой, и запись просто отбрасывается.
+    Дедлайны - время по часам системы, поэтому их можно восстановить после рестарта.
+    """
+
+    def __init__(self, on_deadline):
+        self.on_deadline = on_deadline
+        self.heap = []
+        self.scheduled = set()
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, chat_id: int, deadline: float, phase_id: int) -> bool:
+        """False, если этот таймер уже стоит."""
+        if (chat_id, phase_id) in self.scheduled:
+            return False
+        self.scheduled.add((chat_id, phase_id))
+        heapq.heappush(self.heap, (deadline, chat_id, phase_id))
+        if self.heap[0][1:] == (chat_id, phase_id):
+            self.wakeup.set()
+        return True
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            deadline, chat_id, phase_id = self.heap[0]
+            delay = deadline - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            heapq.heappop(self.heap)
+            self.scheduled.discard((chat_id, phase_id))
+            # Переход шлет сообщения через outbox и не должен задерживать дедлайны других игр
+            start_background(self._fire(chat_id, phase_id))
+
+    async def _fire(self, chat_id: int, phase_id: int):
+        try:
+            await self.on_deadline(chat_id, phase_id)
+        except Exception as e:
+            logging.error(f"Mafia phase timer failed in chat {chat_id}: {e}", exc_info=True)
+
+def read_legacy_json():
+    users, nicks = [], {}
+    if os.path.exists(DB_FILE):
+        try:
+            with open(DB_FILE, "r", encoding="utf-8") as f:
+                users = [tuple(x) for x in json.load(f)]
+        except Exception as e:
+            logging.warning(f"Legacy users file read error: {e}")
+    if os.path.exists(NICKNAMES_FILE):
+        try:
+            with open(NICKNAMES_FILE, "r", encoding="utf-8") as f:
+                nicks = json.load(f)
+        except Exception as e:
+            logging.warning(f"Legacy nicknames file read error: {e}")
+    return users, nicks
+
+class UserStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, chat_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS users_chat_idx ON users (chat_id);
+        CREATE TABLE IF NOT EXISTS nicknames (
+            username TEXT PRIMARY KEY,
+            nickname TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self.pending_users = {}
+        self.pending_nicks = {}
+        self.flush_event = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+
+    async def open(self):
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("PRAGMA synchronous=NORMAL")
+        await self.db.executescript(self.SCHEMA)
+        await self.db.commit()
+        await self.migrate_json()
+
+    async def migrate_json(self):
+        async with self.db.execute("SELECT value FROM meta WHERE key = 'json_migrated'") as cur:
+            if await cur.fetchone():
+                return
+        users, nicks = await asyncio.to_thread(read_legacy_json)
+        now = int(time.time())
+        # В старом файле не было chat_id: пользователь был виден во всех разрешенных чатах
+        await self.db.executemany(
+            "INSERT OR REPLACE INTO users (user_id, chat_id, username, first_name, updated_at) VALUES (?, ?, ?, ?, ?)",
+            [(uid, chat_id, uname, fname, now) for uid, uname, fname in users for chat_id in ALLOWED_CHAT_IDS],
+        )
+        await self.db.executemany(
+            "INSERT OR REPLACE INTO nicknames (username, nickname) VALUES (?, ?)",
+            list(nicks.items()),
+        )
+        await self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (str(now),))
+        await self.db.commit()
+        for path in (DB_FILE, NICKNAMES_FILE):
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+        if users or nicks:
+            logging.info(f"Migrated {len(users)} users and {len(nicks)} nicknames from JSON")
+
+    async def load_users(self) -> list:
+        async with self.db.execute("SELECT chat_id, user_id, username, first_name FROM users") as cur:
+            return await cur.fetchall()
+
+    async def load_nicknames(self) -> dict:
+        async with self.db.execute("SELECT username, nickname FROM nicknames") as cur:
+            return dict(await cur.fetchall())
+
+    def upsert_user(self, chat_id: int, user_id: int, username: str, first_name: str):
+        self.pending_users[(user_id, chat_id)] = (user_id, chat_id, username, first_name, int(time.time()))
+        if len(self.pending_users) >= USER_FLUSH_BATCH:
+            self.flush_event.set()
+
+    def set_nickname(self, username: str, nickname: str):
+        self.pending_nicks[username] = nickname
+        self.flush_event.set()
+
+    async def flush(self):
+        # close() ждет под этим замком запись, начатую флашером, и только потом закрывает базу
+        async with self.flush_lock:
+            if not self.pending_users and not self.pending_nicks:
+                return
+            users, self.pending_users = self.pending_users, {}
+            nicks, self.pending_nicks = self.pending_nicks, {}
+            try:
+                await self.db.executemany(
+                    "INSERT OR REPLACE INTO users (user_id, chat_id, username, first_name, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    list(users.values()),
+                )
+                await self.db.executemany(
+                    "INSERT OR REPLACE INTO nicknames (username, nickname) VALUES (?, ?)",
+                    list(nicks.items()),
+                )
+                await self.db.commit()
+            except Exception as e:
+                logging.error(f"User store flush error: {e}")
+                # Возвращаем в очередь, не затирая более свежие изменения
+                self.pending_users = {**users, **self.pending_users}
+                self.pending_nicks = {**nicks, **self.pending_nicks}
+
+    async def run_flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), USER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            # Отмена флашера при остановке не должна обрывать пачку, уже вынутую из очереди
+            await asyncio.shield(self.flush())
+
+    async def close(self):
+        if self.db is not None:
+            await self.flush()
+            await self.db.close()
+            self.db = None
+
+user_store = UserStore(USERS_DB_PATH)
+
+class UserRegistry:
+    def __init__(self, chunk_size: int = 30):
+        self.chunk_size = chunk_size
+        self.chats = {}
+        self.mentions = {}
+        self.chunks = {}
+        self.nicknames = {}
+        self.by_username = {}
+
+    def upsert(self, chat_id: int, user_id: int, username: str, first_name: str) -> bool:
+        members = self.chats.setdefault(chat_id, {})
+        data = (username, first_name)
+        old = members.get(user_id)
+        if old == data:
+            return False
+        members[user_id] = data
+        if old and old[0]:
+            self.by_username.get(old[0].lower(), set()).discard((chat_id, user_id))
+        if username:
+            self.by_username.setdefault(username.lower(), set()).add((chat_id, user_id))
+        self.mentions.setdefault(chat_id, {})[user_id] = self._mention(user_id, username, first_name)
+        self.chunks.pop(chat_id, None)
+        return True
+
+    def set_nickname(self, username: str, nickname: str):
+        username = username.lower()
+        self.nicknames[username] = nickname
+        for chat_id, user_id in self.by_username.get(username, ()):
+            uname, fname = self.chats[chat_id][user_id]
+            self.mentions[chat_id][user_id] = self._mention(user_id, uname, fname)
+            self.chunks.pop(chat_id, None)
+
+    def mention_chunks(self, chat_id: int) -> list:
+        chunks = self.chunks.get(chat_id)
+        if chunks is None:
+            mentions = list(self.mentions.get(chat_id, {}).values())
+            chunks = [" ".join(mentions[i:i + self.chunk_size]) for i in range(0, len(mentions), self.chunk_size)]
+            self.chunks[chat_id] = chunks
+        return chunks
+
+    def _mention(self, user_id: int, username: str, first_name: str) -> str:
+        nickname = self.nicknames.get(username.lower()) if username else None
+        if nickname:
+            return f'<a href="tg://user?id={user_id}">{html.escape(nickname)}</a>'
+        if username:
+            return f"@{username}"
+        return html.escape(first_name or "")
+
+    def __len__(self) -> int:
+        return sum(len(members) for members in self.chats.values())
+
+user_registry = UserRegistry()
+
+async def load_users():
+    await user_store.open()
+    user_registry.nicknames.update(await user_store.load_nicknames())
+    for chat_id, uid, uname, fname in await user_store.load_users():
+        if owns_chat(chat_id):
+            user_registry.upsert(chat_id, uid, uname, fname)
+    logging.info(f"Loaded {len(user_registry)} chat members and {len(user_registry.nicknames)} nicknames")
+
+async def sync_nicknames():
+    """Подтягивает из базы ники, заданные /tip в других воркерах: реестр у каждого воркера свой."""
+    # Под замком флашера: свои еще не записанные ники новее базы, их не трогаем
+    async with user_store.flush_lock:
+        stored = await user_store.load_nicknames()
+        for username, nickname in stored.items():
+            if username not in user_store.pending_nicks and user_registry.nicknames.get(username) != nickname:
+                user_registry.set_nickname(username, nickname)
+
+def usage_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    price_in, price_out = USAGE_PRICE_TABLE.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+def usage_day(now: float = None) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(now))
+
+class UsageTracker:
+    """Токены Perplexity по дням, чатам, пользователям и моделям.
+
+    Счетчики копятся в памяти и раз в USAGE_FLUSH_INTERVAL прибавляются
+    к строкам в базе, так что воркеры складывают свои доли. Траты за
+    текущие сутки держатся в памяти для проверки дневных бюджетов и после
+    каждой записи перечитываются из базы вместе с долями других воркеров:
+    пользователь, чьи чаты живут в разных воркерах, может превысить бюджет
+    не больше чем на траты одного интервала.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS usage (
+            day TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            PRIMARY KEY (day, scope, id, model)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        # (день, "chat"/"user", id, модель) -> [запросы, токены запроса, токены ответа]
+        self.pending = {}
+        self.day = usage_day()
+        self.spent = {"chat": {}, "user": {}}
+        self.flush_lock = asyncio.Lock()
+
+    async def open(self):
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("PRAGMA synchronous=NORMAL")
+        await self.db.executescript(self.SCHEMA)
+        await self.db.commit()
+        await self.load_spent()
+
+    async def load_spent(self):
+        """Траты за сутки: строки базы (все воркеры) плюс свое, еще не записанное."""
+        day = usage_day()
+        async with self.db.execute(
+            "SELECT scope, id, model, prompt_tokens, completion_tokens FROM usage WHERE day = ?", (day,)
+        ) as cur:
+            rows = await cur.fetchall()
+        spent = {"chat": {}, "user": {}}
+        for scope, item_id, model, prompt_tokens, completion_tokens in rows:
+            totals = spent.setdefault(scope, {})
+            totals[item_id] = totals.get(item_id, 0.0) + usage_cost(model, prompt_tokens, completion_tokens)
+        for (pending_day, scope, item_id, model), (_, prompt_tokens, completion_tokens) in self.pending.items():
+            if pending_day == day:
+                totals = spent.setdefault(scope, {})
+                totals[item_id] = totals.get(item_id, 0.0) + usage_cost(model, prompt_tokens, completion_tokens)
+        self.day = day
+        self.spent = spent
+
+    def _roll_day(self):
+        day = usage_day()
+        if day != self.day:
+            self.day = day
+            self.spent = {"chat": {}, "user": {}}
+
+    def record(self, chat_id: int, user_id: int, model: str, usage: dict):
+        self._roll_day()
+        prompt_tokens = int(usage.get("prompt_tokens") or 0)
+        completion_tokens = int(usage.get("completion_tokens") or 0)
+        LLM_TOKENS.inc(model, "prompt", amount=prompt_tokens)
+        LLM_TOKENS.inc(model, "completion", amount=completion_tokens)
+        cost = usage_cost(model, prompt_tokens, completion_tokens)
+        for scope, item_id in (("chat", chat_id or 0), ("user", user_id)):
+            if item_id is None:
+                continue
+            counters = self.pending.setdefault((self.day, scope, item_id, model), [0, 0, 0])
+            counters[0] += 1
+            counters[1] += prompt_tokens
+            counters[2] += completion_tokens
+            self.spent[scope][item_id] = self.spent[scope].get(item_id, 0.0) + cost
+
+    def over_budget(self, chat_id: int = None, user_id: int = None):
+        """Причина отказа для AdmissionRejected или None."""
+        self._roll_day()
+        if USAGE_CHAT_DAILY_USD and chat_id and self.spent["chat"].get(chat_id, 0.0) >= USAGE_CHAT_DAILY_USD:
+            return "chat_budget"
+        if (USAGE_USER_DAILY_USD and user_id and user_id != ADMIN_ID
+                and self.spent["user"].get(user_id, 0.0) >= USAGE_USER_DAILY_USD):
+            return "user_budget"
+        return None
+
+    async def flush(self):
+        # Как у UserStore: close() дождется записи, начатой флашером
+        async with self.flush_lock:
+            if self.db is None:
+                return
+            if self.pending:
+                pending, self.pending = self.pending, {}
+                try:
+                    await self.db.executemany(
+                        "INSERT INTO usage (day, scope, id, model, requests, prompt_tokens, completion_tokens) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (day, scope, id, model) DO UPDATE SET "
+                        "requests = requests + excluded.requests, "
+                        "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                        "completion_tokens = completion_tokens + excluded.completion_tokens",
+                        [(*key, *values) for key, values in pending.items()],
+                    )
+                    await self.db.commit()
+                except Exception as e:
+                    logging.error(f"Usage flush error: {e}")
+                    for key, values in pending.items():
+                        counters = self.pending.setdefault(key, [0, 0, 0])
+                        for i, value in enumerate(values):
+                            counters[i] += value
+                    return
+            if USAGE_CHAT_DAILY_USD or USAGE_USER_DAILY_USD:
+                await self.load_spent()
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            await asyncio.shield(self.flush())
+
+    async def report(self, days: int, top: int = 5) -> dict:
+        """Сводка с начала суток days дней назад: по моделям и самые дорогие чаты и пользователи."""
+        await self.flush()
+        since = usage_day(time.time() - (days - 1) * 86400)
+        async with self.db.execute(
+            "SELECT scope, id, model, SUM(requests), SUM(prompt_tokens), SUM(completion_tokens) "
+            "FROM usage WHERE day >= ? GROUP BY scope, id, model", (since,)
+        ) as cur:
+            rows = await cur.fetchall()
+        models = {}
+        costs = {"chat": {}, "user": {}}
+        for scope, item_id, model, requests, prompt_tokens, completion_tokens in rows:
+            cost = usage_cost(model, prompt_tokens, completion_tokens)
+            costs.setdefault(scope, {})[item_id] = costs.get(scope, {}).get(item_id, 0.0) + cost
+            if scope == "chat":
+                totals = models.setdefault(model, [0, 0, 0, 0.0])
+                totals[0] += requests
+                totals[1] += prompt_tokens
+                totals[2] += completion_tokens
+                totals[3] += cost
+        return {
+            "since": since,
+            "models": models,
+            "chats": sorted(costs["chat"].items(), key=lambda item: -item[1])[:top],
+            "users": sorted(costs["user"].items(), key=lambda item: -item[1])[:top],
+        }
+
+    async def close(self):
+        if self.db is not None:
+            await self.flush()
+            await self.db.close()
+            self.db = None
+
+usage_tracker = UsageTracker(USERS_DB_PATH)
+
+class PhotoTooLarge(Exception):
+    pass
+
+class PhotoPayload:
+    __slots__ = ("base64", "digest", "size")
+
+    def __init__(self, base64_data: str, digest: str, size: int):
+        self.base64 = base64_data
+        self.digest = digest
+        self.size = size
+
+class PhotoCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+
+    def get(self, file_unique_id: str):
+        payload = self.entries.get(file_unique_id)
+        if payload is not None:
+            self.entries.move_to_end(file_unique_id)
+        return payload
+
+    def put(self, file_unique_id: str, payload: PhotoPayload):
+        if len(payload.base64) > self.max_bytes:
+            return
+        old = self.entries.pop(file_unique_id, None)
+        if old is not None:
+            self.total -= len(old.base64)
+        self.entries[file_unique_id] = payload
+        self.total += len(payload.base64)
+        while self.total > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total -= len(evicted.base64)
+
+photo_cache = PhotoCache(PHOTO_CACHE_BYTES)
+
+def pick_photo_size(sizes: list) -> types.PhotoSize:
+    # Telegram отдает размеры по возрастанию; берем наименьший, где текст еще читается
+    for size in sorted(sizes, key=lambda s: s.width * s.height):
+        if max(size.width, size.height) >= PHOTO_TARGET_SIDE:
+            return size
+    return max(sizes, key=lambda s: s.width * s.height)
+
+def downscale_photo(buf: io.BytesIO):
+    with Image.open(buf) as img:
+        if max(img.size) <= PHOTO_MAX_SIDE and img.format == "JPEG":
+            return None
+        img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=PHOTO_JPEG_QUALITY, optimize=True)
+    return out
+
+def encode_photo(buf: io.BytesIO) -> PhotoPayload:
+    if Image is not None:
+        try:
+            buf.seek(0)
+            smaller = downscale_photo(buf)
+            if smaller is not None:
+                buf.close()
+                buf = smaller
+        except Exception as e:
+            logging.warning(f"Photo downscale error: {e}")
+    with buf:
+        view = buf.getbuffer()
+        try:
+            digest = hashlib.sha256(view).hexdigest()
+            encoded = base64.b64encode(view)
+            size = len(view)
+        finally:
+            view.release()
+    return PhotoPayload(encoded.decode("ascii"), digest, size)
+
+async def load_photo(sizes: list) -> PhotoPayload:
+    photo = pick_photo_size(sizes)
+    payload = photo_cache.get(photo.file_unique_id)
+    if payload is not None:
+        return payload
+    if photo.file_size and photo.file_size > PHOTO_MAX_BYTES:
+        raise PhotoTooLarge()
+    with PHOTO_SECONDS.time():
+        file = await bot.get_file(photo.file_id)
+        buf = io.BytesIO()
+        await bot.download_file(file.file_path, destination=buf)
+        PHOTO_BYTES.observe(buf.getbuffer().nbytes)
+        payload = await asyncio.to_thread(encode_photo, buf)
+    photo_cache.put(photo.file_unique_id, payload)
+    logging.info(f"Photo {photo.width}x{photo.height} loaded: {payload.size} bytes")
+    return payload
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True,
+        )
+        http_session = aiohttp.ClientSession(connector=connector)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+class AnswerSanitizer:
+    """Убирает из ответа ссылки-сноски, LaTeX, жирный шрифт и маркеры списков.
+
+    Результат совпадает с прежней цепочкой из восьми re.sub: порядок проходов
+    тот же, но проход пропускается, если его символов в тексте нет, а
+    шаблоны "с начала строки" привязаны к литералу \\n, что позволяет re
+    искать кандидатов быстрым поиском подстроки вместо проверки каждой позиции.
+    Слить все шаблоны в одну альтернативу нельзя без изменения результата
+    (удаление одних конструкций порождает другие), и в CPython это еще и
+    медленнее: альтернатива теряет поиск по литеральному префиксу.
+    """
+
+    CITATION_RE = re.compile(r'\[(\d+)\]')
+    DISPLAY_MATH_RE = re.compile(r'\\\[.*?\\\]', re.DOTALL)
+    INLINE_MATH_RE = re.compile(r'\\\(.*?\\\)', re.DOTALL)
+    DOUBLE_DOLLAR_RE = re.compile(r'\$\$.*?\$\$', re.DOTALL)
+    DOLLAR_RE = re.compile(r'\$[^\$]+\$')
+    BOLD_RE = re.compile(r'\*\*')
+    # Эквивалент r'^\s*[-•]\s*' с re.MULTILINE: совпадение в начале текста
+    # снимается отдельно, остальные начинаются с \n, который возвращается на место.
+    # Повтор (?:\s*\n[-•])* нужен, когда хвостовой \s* съел перевод строки и
+    # следующая строка тоже начинается с маркера.
+    BULLET_START_RE = re.compile(r'\s*[-•](?:\s*\n[-•])*\s*')
+    BULLET_RE = re.compile(r'\n\s*[-•](?:\s*\n[-•])*\s*')
+    NUMBERED_START_RE = re.compile(r'\s*\d+\.(?:\s*\n\d+\.)*\s*')
+    NUMBERED_RE = re.compile(r'\n\s*\d+\.(?:\s*\n\d+\.)*\s*')
+
+    SENTENCE_END_RE = re.compile(r'[.!?…](?=\s)')
+
+    def strip(self, text: str) -> str:
+        if '[' in text:
+            text = self.CITATION_RE.sub('', text)
+        if '\\[' in text:
+            text = self.DISPLAY_MATH_RE.sub('', text)
+        if '\\(' in text:
+            text = self.INLINE_MATH_RE.sub('', text)
+        if '$' in text:
+            text = self.DOUBLE_DOLLAR_RE.sub('', text)
+            text = self.DOLLAR_RE.sub('', text)
+        if '**' in text:
+            text = self.BOLD_RE.sub('', text)
+        text = self._strip_line_prefix(text, self.BULLET_START_RE, self.BULLET_RE)
+        return self._strip_line_prefix(text, self.NUMBERED_START_RE, self.NUMBERED_RE)
+
+    @staticmethod
+    def _strip_line_prefix(text: str, start_re: re.Pattern, line_re: re.Pattern) -> str:
+        m = start_re.match(text)
+        if m:
+            text = text[m.end():]
+        if '\n' in text:
+            text = line_re.sub('\n', text)
+        return text
+
+    def clean(self, text: str) -> str:
+        return self.strip(text).strip()
+
+    def split(self, text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+        parts = []
+        while len(text) > limit:
+            window = text[:limit]
+            cut = window.rfind("\n\n")
+            if cut < limit // 2:
+                cut = window.rfind("\n")
+            if cut < limit // 2:
+                cut = -1
+                for m in self.SENTENCE_END_RE.finditer(window, limit // 2):
+                    cut = m.end()
+            if cut < limit // 2:
+                cut = window.rfind(" ")
+            if cut <= 0:
+                cut = limit
+            parts.append(text[:cut].rstrip())
+            text = text[cut:].lstrip()
+        if text:
+            parts.append(text)
+        return parts
+
+    def stream(self) -> "StreamCleaner":
+        return StreamCleaner(self)
+
+_DOLLAR_MATH_RE = re.compile(r'\$\$.*?\$\$|\$[^\$]+\$', re.DOTALL)
+_OPEN_TAIL_RE = re.compile(r'\[\d*$|\*+$|\\$')
+
+def _open_dollar(text: str) -> int:
+    if text.count('$$') % 2:
+        return text.rfind('$$')
+    end = 0
+    for m in _DOLLAR_MATH_RE.finditer(text):
+        end = m.end()
+    return text.find('$', end)
+
+def _is_balanced(text: str) -> bool:
+    return (
+        _open_dollar(text) == -1
+        and text.count('\\[') == text.count('\\]')
+        and text.count('\\(') == text.count('\\)')
+    )
+
+def _paragraph_start(text: str, end: int) -> int:
+    # Начало абзаца, который заканчивается в end
+    pos = text.rfind("\n\n", 0, end)
+    return pos + 2 if pos != -1 else 0
+
+def _open_tail_start(text: str) -> int:
+    # Позиция, с которой начинается незакрытая формула/ссылка в хвосте потока
+    cut = len(text)
+    pos = _open_dollar(text)
+    if pos != -1:
+        cut = pos
+    for opener, closer in (('\\[', '\\]'), ('\\(', '\\)')):
+        pos = text.rfind(opener)
+        if pos > text.rfind(closer):
+            cut = min(cut, pos)
+    m = _OPEN_TAIL_RE.search(text)
+    if m:
+        cut = min(cut, m.start())
+    return cut
+
+class StreamCleaner:
+    """Чистит ответ по мере прихода токенов.
+
+    Завершенные абзацы чистятся один раз и больше не трогаются, хвост
+    показывается только до первой незакрытой формулы или ссылки.
+    Незакрытой считается только формула в текущем абзаце: одиночный $
+    ("стоит $5") не должен навсегда останавливать превью. Каждый кусок
+    проверяется только на новые разрывы абзацев, без повторного прохода по хвосту.
+    """
+
+    def __init__(self, sanitizer: AnswerSanitizer):
+        self.sanitizer = sanitizer
+        self.raw = []
+        self.done = ""
+        self.tail = ""
+
+    def feed(self, delta: str):
+        self.raw.append(delta)
+        # Разрыв мог начаться последним символом прошлого куска
+        start = max(0, len(self.tail) - 1)
+        self.tail += delta
+        cut = self.tail.rfind("\n\n", start)
+        while cut > 0 and not _is_balanced(self.tail[_paragraph_start(self.tail, cut):cut]):
+            cut = self.tail.rfind("\n\n", start, cut)
+        if cut > 0:
+            self.done += self.sanitizer.strip(self.tail[:cut + 1])
+            self.tail = self.tail[cut + 1:]
+
+    def text(self) -> str:
+        return "".join(self.raw)
+
+    def preview(self) -> str:
+        para = _paragraph_start(self.tail, len(self.tail))
+        tail = self.tail[:para + _open_tail_start(self.tail[para:])]
+        return (self.done + self.sanitizer.strip(tail)).strip()
+
+sanitizer = AnswerSanitizer()
+
+async def reply_answer(message: types.Message, answer: str) -> list:
+    sent = []
+    for part in sanitizer.split(answer):
+        sent.append(await outbox.reply(message, part, priority=PRIORITY_HIGH, parse_mode=None))
+    return [m.message_id for m in sent if m is not None]
+
+class StreamingReply:
+    def __init__(self, message: types.Message):
+        self.message = message
+        self.sent = None
+        self.shown = ""
+        self.next_edit = 0.0
+        self.pending = None
+        if message.chat.type == types.ChatType.PRIVATE:
+            self.interval = STREAM_EDIT_INTERVAL
+        else:
+            self.interval = STREAM_GROUP_EDIT_INTERVAL
+
+    async def update(self, cleaner: StreamCleaner):
+        now = asyncio.get_running_loop().time()
+        if now < self.next_edit or (self.pending is not None and not self.pending.done()):
+            return
+        text = cleaner.preview()
+        if len(text) < STREAM_MIN_CHARS or text == self.shown:
+            return
+        # Несколько ответов в одном чате делят его лимит правок: лишние превью
+        # пропускаются, следующее все равно покажет более свежий текст
+        if self.sent is not None and not outbox.can_edit(self.sent.chat.id):
+            return
+        if len(text) > TELEGRAM_MESSAGE_LIMIT - 2:
+            text = sanitizer.split(text, TELEGRAM_MESSAGE_LIMIT - 2)[0]
+        self.next_edit = now + self.interval
+        self.shown = text
+        # Не ждем Telegram: чтение потока продолжается, пока правка в очереди
+        self.pending = asyncio.ensure_future(self._show(text + " …"))
+
+    async def finish(self, answer: str) -> list:
+        if self.pending is not None:
+            await self.pending
+        if self.sent is None:
+            return await reply_answer(self.message, answer)
+        first, *rest = sanitizer.split(answer)
+        try:
+            await outbox.edit_text(self.sent.chat.id, self.sent.message_id, first, parse_mode=None)
+        except MessageNotModified:
+            pass
+        sent = [self.sent.message_id]
+        for part in rest:
+            part_message = await outbox.reply(self.message, part, priority=PRIORITY_HIGH, parse_mode=None)
+            if part_message is not None:
+                sent.append(part_message.message_id)
+        return sent
+
+    async def _show(self, text: str):
+        try:
+            if self.sent is None:
+                self.sent = await outbox.reply(self.message, text, priority=PRIORITY_HIGH, parse_mode=None)
+            else:
+                await outbox.edit_text(self.sent.chat.id, self.sent.message_id, text, parse_mode=None)
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logging.warning(f"Stream edit error: {e}")
+
+async def read_stream(resp: aiohttp.ClientResponse, on_partial) -> tuple:
+    """(текст, usage из последнего чанка, где он был)."""
+    cleaner = sanitizer.stream()
+    usage = None
+    async for line in resp.content:
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+        chunk = json.loads(data)
+        usage = chunk.get('usage') or usage
+        choice = chunk['choices'][0]
+        delta = (choice.get('delta') or {}).get('content')
+        if delta:
+            cleaner.feed(delta)
+            await on_partial(cleaner)
+        if choice.get('finish_reason'):
+            break
+    return cleaner.text(), usage
+
+class AnswerCache:
+    def __init__(self, max_entries: int, ttl: float, path: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    @staticmethod
+    def make_key(question: str, is_school_task: bool, model: str, photo_digest: str = "", context_digest: str = "") -> str:
+        normalized = " ".join(question.lower().split()).strip("?!.,… ")
+        raw = f"{normalized}\x00{int(bool(is_school_task))}\x00{model}\x00{photo_digest}"
+        if context_digest:
+            raw += f"\x00{context_digest}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, answer = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            self.dirty = True
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return answer
+
+    def put(self, key: str, answer: str):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        self.entries[key] = (time.time() + self.ttl, answer)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.warning(f"Answer cache load error: {e}")
+            return
+        now = time.time()
+        for key, expires_at, answer in data[-self.max_entries:]:
+            if expires_at > now:
+                self.entries[key] = (expires_at, answer)
+        logging.info(f"Answer cache loaded: {len(self.entries)} entries")
+
+    async def save(self):
+        if not self.path:
+            return
+        # Список собирается в цикле событий: обработчики меняют entries, пока поток пишет файл
+        now = time.time()
+        data = [[key, expires_at, answer] for key, (expires_at, answer) in self.entries.items() if expires_at > now]
+        self.dirty = False
+        await asyncio.to_thread(self._write, data)
+
+    def _write(self, data: list):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.warning(f"Answer cache save error: {e}")
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_FILE or None)
+
+async def answer_cache_saver():
+    while True:
+        await asyncio.sleep(ANSWER_CACHE_SAVE_INTERVAL)
+        if answer_cache.dirty:
+            await answer_cache.save()
+            logging.info(f"Answer cache saved: {answer_cache.stats()}")
+
+def estimate_tokens(text: str) -> int:
+    # Без токенизатора: для смеси русского и латиницы выходит около 3 символов на токен
+    return len(text) // 3 + 1
+
+def _pack_text(text: str, limit: int) -> bytes:
+    data = text[:limit].encode()
+    packed = zlib.compress(data)
+    return b"z" + packed if len(packed) + 1 < len(data) else b"r" + data
+
+def _unpack_text(blob: bytes) -> str:
+    data = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return data.decode()
+
+CONTEXT_USER = "user"
+CONTEXT_ASSISTANT = "assistant"
+
+class ChatContext:
+    """Кольцо последних вопросов и ответов одного чата.
+
+    Слот - кортеж (message_id, parent_id, role, текст). Продолжения длинного
+    ответа хранятся с role=None и пустым текстом и ссылаются на первую часть.
+    """
+    __slots__ = ("slots", "index", "pos")
+
+    def __init__(self, size: int):
+        self.slots = [None] * size
+        self.index = {}
+        self.pos = 0
+
+    def add(self, message_id: int, parent_id, role, blob: bytes):
+        old = self.slots[self.pos]
+        if old is not None and self.index.get(old[0]) == self.pos:
+            del self.index[old[0]]
+        self.slots[self.pos] = (message_id, parent_id, role, blob)
+        self.index[message_id] = self.pos
+        self.pos = (self.pos + 1) % len(self.slots)
+
+    def get(self, message_id: int):
+        slot = self.index.get(message_id)
+        return None if slot is None else self.slots[slot]
+
+class ConversationStore:
+    """Цепочки "вопрос - ответ бота - ответ на ответ" для follow-up вопросов.
+
+    Чаты вытесняются по LRU, внутри чата старые сообщения перезаписываются
+    по кругу, текст обрезан и сжат, так что память ограничена сверху
+    независимо от числа чатов и сообщений.
+    """
+
+    def __init__(self, max_chats: int, per_chat: int, max_chars: int):
+        self.max_chats = max_chats
+        self.per_chat = per_chat
+        self.max_chars = max_chars
+        self.chats = OrderedDict()
+
+    def _chat(self, chat_id: int, create: bool = False):
+        ctx = self.chats.get(chat_id)
+        if ctx is not None:
+            self.chats.move_to_end(chat_id)
+        elif create and self.max_chats > 0 and self.per_chat > 0:
+            ctx = self.chats[chat_id] = ChatContext(self.per_chat)
+            while len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        return ctx
+
+    def is_answer(self, chat_id: int, message_id: int) -> bool:
+        ctx = self.chats.get(chat_id)
+        entry = ctx.get(message_id) if ctx is not None else None
+        return entry is not None and entry[2] != CONTEXT_USER
+
+    def record(self, chat_id: int, message_id: int, parent_id, question: str, answer_ids: list, answer: str):
+        ctx = self._chat(chat_id, create=True)
+        if ctx is None or not answer_ids:
+            return
+        ctx.add(message_id, parent_id, CONTEXT_USER, _pack_text(question, self.max_chars))
+        first, *rest = answer_ids
+        ctx.add(first, message_id, CONTEXT_ASSISTANT, _pack_text(answer, self.max_chars))
+        for part_id in rest:
+            ctx.add(part_id, first, None, b"")
+
+    def history(self, chat_id: int, reply_to_id: int, budget: int, max_depth: int) -> list:
+        """Сообщения цепочки до reply_to_id в хронологическом порядке, в пределах budget токенов."""
+        ctx = self._chat(chat_id)
+        if ctx is None:
+            return []
+        turns = []
+        expected = CONTEXT_ASSISTANT
+        message_id = reply_to_id
+        while message_id is not None and len(turns) < max_depth:
+            entry = ctx.get(message_id)
+            if entry is None:
+                break
+            _, parent_id, role, blob = entry
+            if role is None:
+                message_id = parent_id
+                continue
+            # Perplexity требует чередования user/assistant
+            if role != expected:
+                break
+            text = _unpack_text(blob)
+            budget -= estimate_tokens(text)
+            if budget < 0:
+                break
+            turns.append({"role": role, "content": text})
+            expected = CONTEXT_USER if role == CONTEXT_ASSISTANT else CONTEXT_ASSISTANT
+            message_id = parent_id
+        if turns and turns[-1]["role"] == CONTEXT_ASSISTANT:
+            turns.pop()
+        turns.reverse()
+        return turns
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self.chats),
+            "messages": sum(len(ctx.index) for ctx in self.chats.values()),
+            "bytes": sum(len(slot[3]) for ctx in self.chats.values() for slot in ctx.slots if slot is not None),
+        }
+
+conversations = ConversationStore(CONTEXT_CHATS, CONTEXT_MESSAGES_PER_CHAT, CONTEXT_MESSAGE_CHARS)
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float = 1.0) -> float:
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float = 1.0):
+        self._refill()
+        self.tokens -= amount
+
+    def try_take(self, amount: float = 1.0) -> bool:
+        if self.delay(amount) > 0:
+            return False
+        self.tokens -= amount
+        return True
+
+class AdmissionRejected(Exception):
+    MESSAGES = {
+        "user": "Не так быстро, подожди немного и спроси снова.",
+        "chat": "В чате слишком много вопросов, подожди немного.",
+        "busy": "Улитка сейчас занята, попробуй через минуту.",
+        "chat_budget": "Лимит вопросов для этого чата на сегодня исчерпан, продолжим завтра.",
+        "user_budget": "Твой лимит вопросов на сегодня исчерпан, продолжим завтра.",
+    }
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+    @property
+    def text(self) -> str:
+        return self.MESSAGES[self.reason]
+
+class AdmissionController:
+    MAX_BUCKETS = 10000
+
+    def __init__(self, max_concurrency: int, queue_size: int, queue_timeout: float):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.user_buckets = OrderedDict()
+        self.chat_buckets = OrderedDict()
+        self.backoff_until = 0.0
+        self.backoff_step = 0
+
+    def _bucket(self, buckets: OrderedDict, key, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+            if len(buckets) > self.MAX_BUCKETS:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def check(self, user_id: int = None, chat_id: int = None):
+        user_bucket = self._bucket(self.user_buckets, user_id, LLM_USER_RATE, LLM_USER_BURST) if user_id else None
+        chat_bucket = self._bucket(self.chat_buckets, chat_id, LLM_CHAT_RATE, LLM_CHAT_BURST) if chat_id else None
+        if user_bucket and user_bucket.delay() > 0:
+            raise AdmissionRejected("user")
+        if chat_bucket and chat_bucket.delay() > 0:
+            raise AdmissionRejected("chat")
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            raise AdmissionRejected("busy")
+        if user_bucket:
+            user_bucket.take()
+        if chat_bucket:
+            chat_bucket.take()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int = None, chat_id: int = None):
+        self.check(user_id, chat_id)
+        if self.semaphore.locked():
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise AdmissionRejected("busy")
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+    async def wait_backoff(self):
+        delay = self.backoff_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def report_throttled(self, retry_after: float = None) -> float:
+        self.backoff_step = min(self.backoff_step + 1, 8)
+        if retry_after is None:
+            delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (self.backoff_step - 1))
+            delay *= random.uniform(0.5, 1.0)
+        else:
+            delay = min(LLM_BACKOFF_MAX, retry_after)
+        self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+        logging.warning(f"Perplexity throttled, backing off {delay:.1f}s (step {self.backoff_step})")
+        return delay
+
+    def report_success(self):
+        if self.backoff_step:
+            self.backoff_step -= 1
+
+def parse_retry_after(value: str):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+admission = AdmissionController(LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUT)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class SendScheduler:
+    """Единая очередь исходящих сообщений с учетом лимитов Telegram.
+
+    У каждого чата своя очередь по приоритету и свой token bucket, общий
+    bucket ограничивает бота целиком и выдает токены тоже по приоритету.
+    Разные чаты отправляются параллельно, внутри чата порядок сохраняется.
+    """
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.chat_buckets = OrderedDict()
+        self.edit_buckets = OrderedDict()
+        self.queues = {}
+        self.workers = {}
+        self.global_waiters = []
+        self.pacer = None
+        self.seq = itertools.count()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id < 0:
+            return self._bucket(self.chat_buckets, chat_id, TG_GROUP_RATE_PER_MIN / 60, TG_GROUP_BURST)
+        return self._bucket(self.chat_buckets, chat_id, TG_PRIVATE_RATE, TG_PRIVATE_BURST)
+
+    def _edit_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id < 0:
+            return self._bucket(self.edit_buckets, chat_id, TG_GROUP_EDIT_RATE_PER_MIN / 60, TG_GROUP_EDIT_BURST)
+        return self._bucket(self.edit_buckets, chat_id, TG_PRIVATE_RATE, TG_PRIVATE_BURST)
+
+    def _bucket(self, buckets: OrderedDict, chat_id: int, rate: float, capacity: float) -> TokenBucket:
+        bucket = buckets.get(chat_id)
+        if bucket is None:
+            bucket = buckets[chat_id] = TokenBucket(rate, capacity)
+            if len(buckets) > self.MAX_CHAT_BUCKETS:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(chat_id)
+        return bucket
+
+    def can_edit(self, chat_id: int) -> bool:
+        """Есть ли в чате лимит на промежуточную правку; если нет, ее лучше пропустить."""
+        return self._edit_bucket(chat_id).delay() == 0
+
+    async def send(self, chat_id: int, func, *args, priority: int = PRIORITY_NORMAL, chat_cost: float = 1.0, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queues.setdefault(chat_id, []), (priority, next(self.seq), chat_cost, func, args, kwargs, future))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = start_background(self._run_chat(chat_id))
+        with SEND_SECONDS.time(func.__name__):
+            return await future
+
+    async def _run_chat(self, chat_id: int):
+        queue = self.queues[chat_id]
+        bucket = self._chat_bucket(chat_id)
+        try:
+            while queue:
+                priority, _, chat_cost, func, args, kwargs, future = heapq.heappop(queue)
+                while not future.done():
+                    delay = bucket.delay(chat_cost) if chat_cost else 0
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                        continue
+                    await self._acquire_global(priority)
+                    if chat_cost:
+                        bucket.take(chat_cost)
+                    try:
+                        result = await func(*args, **kwargs)
+                    except RetryAfter as e:
+                        logging.warning(f"Flood control in chat {chat_id}: retry after {e.timeout}s")
+                        await asyncio.sleep(e.timeout)
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            del self.workers[chat_id]
+            if not queue:
+                del self.queues[chat_id]
+
+    async def _acquire_global(self, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.global_waiters, (priority, next(self.seq), future))
+        if self.pacer is None or self.pacer.done():
+            self.pacer = start_background(self._pace())
+        await future
+
+    async def _pace(self):
+        while self.global_waiters:
+            delay = self.global_bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self.global_waiters)
+            if not future.done():
+                self.global_bucket.take()
+                future.set_result(None)
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.send(chat_id, bot.send_message, chat_id, text, priority=priority, **kwargs)
+
+    async def reply(self, message: types.Message, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.send(message.chat.id, message.reply, text, priority=priority, **kwargs)
+
+    async def answer(self, message: types.Message, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.send(message.chat.id, message.answer, text, priority=priority, **kwargs)
+
+    async def edit_text(self, chat_id: int, message_id: int, text: str, priority: int = PRIORITY_HIGH, **kwargs):
+        # Правки не создают новых сообщений и не ждут лимита чата. Они списываются
+        # с отдельного лимита правок, по которому потоковые ответы пропускают превью
+        self._edit_bucket(chat_id).take()
+        return await self.send(chat_id, bot.edit_message_text, text, chat_id, message_id,
+                               priority=priority, chat_cost=0, **kwargs)
+
+outbox = SendScheduler()
+
+def choose_model(photo: PhotoPayload = None) -> str:
+    return "sonar-pro" if photo else "sonar"
+
+GREETING_RE = re.compile(r"(привет|здравствуй|здрасьте|хай|hi|hello|добр\w+ (утро|день|вечер)|спасибо|пока|как дела)\b")
+
+def choose_max_tokens(question: str, is_school_task: bool, photo: PhotoPayload = None) -> int:
+    if photo:
+        return LLM_MAX_TOKENS_PHOTO
+    if is_school_task:
+        return LLM_MAX_TOKENS_SCHOOL
+    if len(question) <= 40 and GREETING_RE.match(question.strip().lower()):
+        return LLM_MAX_TOKENS_GREETING
+    return LLM_MAX_TOKENS_GENERAL
+
+class UpstreamError(Exception):
+    def __init__(self, reason: str, status: int = None, retry_after: float = None):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+class ModelStats:
+    __slots__ = ("latencies", "outcomes")
+
+    def __init__(self, window: int):
+        # Время до первого байта успешных запросов и (время, ok) всех попыток
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
 
-try:
-    ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
-    allowed_chats_str = os.getenv("ALLOWED_CHAT_ID", "0")
-    ALLOWED_CHAT_IDS = [int(x.strip()) for x in allowed_chats_str.split(",") if x.strip()]
-    
-    if not ALLOWED_CHAT_IDS or ALLOWED_CHAT_IDS == [0]:
-        logging.error("ALLOWED_CHAT_ID не настроен!")
-        exit(1)
-except ValueError:
-    logging.error("ADMIN_ID или ALLOWED_CHAT_ID должны быть числами!")
-    exit(1)
+    def error_rate(self, since: float):
+        recent = [ok for at, ok in self.outcomes if at >= since]
+        if len(recent) < LLM_LATENCY_MIN_SAMPLES:
+            return None
+        return 1 - sum(recent) / len(recent)
 
-DB_FILE = "/data/users_db.json"
-NICKNAMES_FILE = "/data/nicks.json"
+class ModelRouter:
+    """Скользящая статистика по моделям: куда слать запрос и когда его дублировать.
 
-if not BOT_TOKEN or not PERPLEXITY_API_KEY:
-    logging.error("ОШИБКА: Не найдены BOT_TOKEN или PERPLEXITY_API_KEY в переменных окружения!")
-    exit(1)
+    Модель с долей ошибок выше LLM_MODEL_MAX_ERROR_RATE уступает место
+    запасной, пока ошибки не уйдут из окна LLM_HEALTH_WINDOW. Дубль
+    отправляется, если запрос ждет первого байта дольше перцентиля
+    LLM_HEDGE_PERCENTILE, и не чаще LLM_HEDGE_BUDGET от числа запросов.
+    """
 
-logging.basicConfig(level=logging.INFO)
-storage = MemoryStorage()
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(bot, storage=storage)
-known_users = set()
-nicknames = {}
+    def __init__(self):
+        self.models = {}
+        self.hedge_tokens = LLM_HEDGE_BURST
 
-def is_allowed_chat(message: types.Message) -> bool:
-    return message.chat.id in ALLOWED_CHAT_IDS
+    def stats(self, model: str) -> ModelStats:
+        stats = self.models.get(model)
+        if stats is None:
+            stats = self.models[model] = ModelStats(LLM_LATENCY_WINDOW)
+        return stats
 
-# Игры Мафии
-mafia_games = {}
+    def record(self, model: str, ok: bool, latency: float = None):
+        stats = self.stats(model)
+        stats.outcomes.append((time.monotonic(), ok))
+        if latency is not None:
+            stats.latencies.append(latency)
+            PERPLEXITY_FIRST_BYTE.observe(latency, model)
 
-class MafiaGame:
-    def __init__(self, chat_id):
-        self.chat_id = chat_id
-        self.players = []
-        self.mafia = []
-        self.detective = None
-        self.doctor = None
-        self.alive = []
-        self.phase = "registration"
-        self.day_num = 0
-        self.night_actions = {}
+    def route(self, model: str, fallback: str) -> tuple:
+        """(модель для запроса, модель для дубля)."""
+        if fallback == model:
+            return model, fallback
+        since = time.monotonic() - LLM_HEALTH_WINDOW
+        primary_errors = self.stats(model).error_rate(since)
+        if primary_errors is not None and primary_errors > LLM_MODEL_MAX_ERROR_RATE:
+            fallback_errors = self.stats(fallback).error_rate(since)
+            if fallback_errors is None or fallback_errors < primary_errors:
+                logging.info(f"Routing {model} traffic to {fallback}: {primary_errors:.0%} errors")
+                return fallback, model
+        return model, fallback
 
-def load_data():
-    global known_users, nicknames
-    if os.path.exists(DB_FILE):
-        try:
-            with open(DB_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                known_users = set(tuple(x) for x in data)
-        except:
-            known_users = set()
-    if os.path.exists(NICKNAMES_FILE):
-        try:
-            with open(NICKNAMES_FILE, "r", encoding="utf-8") as f:
-                nicknames = json.load(f)
-        except:
-            nicknames = {}
+    def hedge_delay(self, model: str) -> float:
+        stats = self.stats(model)
+        if len(stats.latencies) < LLM_LATENCY_MIN_SAMPLES:
+            return LLM_HEDGE_DELAY
+        return min(LLM_FIRST_BYTE_TIMEOUT, max(LLM_HEDGE_MIN_DELAY, stats.percentile(LLM_HEDGE_PERCENTILE)))
 
-def save_users():
-    try:
-        with open(DB_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(known_users), f, ensure_ascii=False)
-    except: pass
+    def note_request(self):
+        self.hedge_tokens = min(LLM_HEDGE_BURST, self.hedge_tokens + LLM_HEDGE_BUDGET)
 
-def save_nicks():
-    try:
-        with open(NICKNAMES_FILE, "w", encoding="utf-8") as f:
-            json.dump(nicknames, f, ensure_ascii=False)
-    except: pass
+    def take_hedge(self) -> bool:
+        if self.hedge_tokens < 1:
+            return False
+        self.hedge_tokens -= 1
+        return True
 
-load_data()
+model_router = ModelRouter()
+PERPLEXITY_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=LLM_CONNECT_TIMEOUT, sock_read=LLM_FIRST_BYTE_TIMEOUT)
 
-async def download_photo(file_id: str) -> bytes:
-    file = await bot.get_file(file_id)
-    photo_bytes = await bot.download_file(file.file_path)
-    return photo_bytes.read()
+class HedgedCall:
+    """Запрос к Perplexity, который при задержке дублируется.
 
-async def ask_perplexity(question: str, is_school_task: bool = False, photo_base64: str = None) -> str:
-    try:
+    Побеждает попытка, первой получившая ответ 200: вторая сразу отменяется,
+    поэтому в поток ответа пишет только одна из них.
+    """
+
+    def __init__(self, payload: dict, on_partial=None):
+        self.payload = payload
+        self.on_partial = on_partial
+        self.tasks = []
+        self.models = {}
+        self.hedge = None
+        self.winner = None
+        # Модели попыток, отмененных в полете: запрос уже ушел и оплачивается
+        self.abandoned = []
+
+    async def run(self, model: str, hedge_model: str) -> tuple:
+        """(ответ, usage, модель, которая ответила)."""
+        model_router.note_request()
+        primary = self._launch(model)
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=model_router.hedge_delay(model))
+            if not done and self.winner is None and model_router.take_hedge():
+                logging.info(f"Hedging slow {model} request with {hedge_model}")
+                self.hedge = self._launch(hedge_model)
+            return await self._first_success()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+
+    def _launch(self, model: str) -> asyncio.Task:
+        task = asyncio.ensure_future(self._attempt(model))
+        self.tasks.append(task)
+        self.models[task] = model
+        return task
+
+    def _claim(self, task: asyncio.Task, model: str) -> bool:
+        if self.winner is not None:
+            return self.winner is task
+        self.winner = task
+        if self.hedge is not None:
+            PERPLEXITY_HEDGES.inc(model, "hedge" if task is self.hedge else "primary")
+        for other in self.tasks:
+            if other is not task and not other.done():
+                self.abandoned.append(self.models[other])
+                other.cancel()
+        return True
+
+    async def _first_success(self) -> tuple:
+        pending = set(self.tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+        raise error or UpstreamError("exception")
+
+    async def _attempt(self, model: str) -> tuple:
         headers = {
             "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
             "Content-Type": "application/json"
         }
-        
+        started = time.perf_counter()
+        try:
+            async with get_http_session().post(PERPLEXITY_API_URL, headers=headers, json=dict(self.payload, model=model),
+                                               timeout=PERPLEXITY_TIMEOUT) as resp:
+                if resp.status == 429:
+                    raise UpstreamError("429", resp.status, parse_retry_after(resp.headers.get("Retry-After")))
+                if resp.status != 200:
+                    error_text = await resp.text()
+                    logging.error(f"API error {resp.status} from {model}: {error_text}")
+                    raise UpstreamError(f"http_{resp.status}", resp.status)
+                if not self._claim(asyncio.current_task(), model):
+                    raise asyncio.CancelledError()
+                model_router.record(model, True, time.perf_counter() - started)
+                if self.on_partial is not None:
+                    answer, usage = await read_stream(resp, self.on_partial)
+                    return answer, usage, model
+                result = await resp.json()
+                return result['choices'][0]['message']['content'], result.get('usage'), model
+        except UpstreamError:
+            model_router.record(model, False)
+            raise
+        except asyncio.TimeoutError:
+            model_router.record(model, False)
+            raise UpstreamError("timeout")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Query error for {model}: {e}", exc_info=True)
+            model_router.record(model, False)
+            raise UpstreamError("exception") from e
+
+def context_digest(history: list) -> str:
+    if not history:
+        return ""
+    raw = "\x00".join(f"{turn['role']}\x01{turn['content']}" for turn in history)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+async def ask_perplexity(question: str, is_school_task: bool = False, photo: PhotoPayload = None, on_partial=None,
+                         user_id: int = None, chat_id: int = None, history: list = ()):
+    """Возвращает (ответ, ok); ok=False, если вместо ответа текст ошибки или отказа."""
+    model = choose_model(photo)
+    key = answer_cache.make_key(question, is_school_task, model, photo.digest if photo else "", context_digest(history))
+    started = time.perf_counter()
+    answer = answer_cache.get(key)
+    if answer is not None:
+        logging.info(f"Answer cache hit: {answer_cache.stats()}")
+        ASK_SECONDS.observe(time.perf_counter() - started, model, "cache")
+        return answer, True
+    try:
+        flight = inflight_requests.get(key)
+        if flight is None:
+            # Кэш и общий запрос в полете бесплатны, бюджет проверяется только для нового запроса
+            budget = usage_tracker.over_budget(chat_id, user_id)
+            if budget:
+                raise AdmissionRejected(budget)
+            admission.check(user_id, chat_id)
+            flight = asyncio.ensure_future(fetch_answer(key, question, is_school_task, photo, model, on_partial, history,
+                                                        user_id, chat_id))
+            inflight_requests[key] = flight
+            flight.add_done_callback(lambda f: _finish_flight(key, f))
+        else:
+            logging.info(f"Joined in-flight request for model {model}")
+        # shield: отмена одного ожидающего не должна отменять общий запрос для остальных
+        answer, ok = await asyncio.shield(flight)
+        ASK_SECONDS.observe(time.perf_counter() - started, model, "ok" if ok else "error")
+        return answer, ok
+    except AdmissionRejected as e:
+        logging.info(f"LLM request rejected ({e.reason}) for user {user_id} in chat {chat_id}")
+        ASK_SECONDS.observe(time.perf_counter() - started, model, "rejected")
+        return e.text, False
+
+inflight_requests = {}
+
+def _finish_flight(key: str, flight: asyncio.Future):
+    if inflight_requests.get(key) is flight:
+        del inflight_requests[key]
+    if not flight.cancelled():
+        flight.exception()
+
+async def fetch_answer(key: str, question: str, is_school_task: bool, photo: PhotoPayload, model: str, on_partial=None,
+                       history: list = (), user_id: int = None, chat_id: int = None):
+    async with admission.slot():
+        started = time.perf_counter()
+        answer, ok = await request_perplexity(question, is_school_task, photo, model, on_partial, history, user_id, chat_id)
+        PERPLEXITY_SECONDS.observe(time.perf_counter() - started, model, "ok" if ok else "error")
+    if ok:
+        answer_cache.put(key, answer)
+    return answer, ok
+
+async def request_perplexity(question: str, is_school_task: bool, photo: PhotoPayload, model: str, on_partial=None,
+                             history: list = (), user_id: int = None, chat_id: int = None):
+    try:
         base_system_prompt = (
             "Твое имя Улитка. "
             "Стиль общения: дружелюбный, простой, без лишних подробностей. "
@@ -119,20 +2582,19 @@ async def ask_perplexity(question: str, is_school_task: bool = False, photo_base
         else:
             system_prompt = base_system_prompt
         
-        model = "sonar-pro" if photo_base64 else "sonar"
-        
         messages = [
             {"role": "system", "content": system_prompt}
         ]
+        messages.extend(history)
         
-        if photo_base64:
+        if photo:
             messages.append({
                 "role": "user",
                 "content": [
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{photo_base64}"
+                            "url": f"data:image/jpeg;base64,{photo.base64}"
                         }
                     },
                     {
@@ -151,89 +2613,583 @@ async def ask_perplexity(question: str, is_school_task: bool = False, photo_base
             "messages": messages,
             "temperature": 0.2,
             "top_p": 0.9,
-            "max_tokens": 4000,
-            "search_recency_filter": "month",
+            "max_tokens": choose_max_tokens(question, is_school_task, photo),
+            "search_recency_filter": SEARCH_RECENCY_FILTER,
             "return_images": False,
             "return_related_questions": False,
-            "stream": False,
+            "stream": on_partial is not None,
             "presence_penalty": 0,
             "frequency_penalty": 1
         }
         
+        fallback = LLM_FALLBACK_MODEL if LLM_FALLBACK_MODEL and not photo else model
+        routed, hedge_model = model_router.route(model, fallback)
         for attempt in range(3):
+            await admission.wait_backoff()
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post("https://api.perplexity.ai/chat/completions", 
-                                           headers=headers, 
-                                           json=payload, 
-                                           timeout=aiohttp.ClientTimeout(total=60)) as resp:
-                        if resp.status == 200:
-                            result = await resp.json()
-                            answer = result['choices'][0]['message']['content']
-                            if not answer:
-                                return "Не смог сформулировать ответ. Попробуй переформулировать."
-                            
-                            answer = re.sub(r'\[(\d+)\]', '', answer)
-                            answer = re.sub(r'\\\[.*?\\\]', '', answer, flags=re.DOTALL)
-                            answer = re.sub(r'\\\(.*?\\\)', '', answer, flags=re.DOTALL)
-                            answer = re.sub(r'\$\$.*?\$\$', '', answer, flags=re.DOTALL)
-                            answer = re.sub(r'\$[^\$]+\$', '', answer)
-                            answer = re.sub(r'\*\*', '', answer)
-                            answer = re.sub(r'^\s*[-•]\s*', '', answer, flags=re.MULTILINE)
-                            answer = re.sub(r'^\s*\d+\.\s*', '', answer, flags=re.MULTILINE)
-                            
-                            if len(answer) > 3500:
-                                answer = answer[:3497] + "..."
-                            
-                            return answer.strip()
-                        elif resp.status == 429:
-                            if attempt < 2:
-                                await asyncio.sleep(3)
-                                continue
-                            return "Слишком много запросов. Попробуй через минуту."
-                        else:
-                            error_text = await resp.text()
-                            logging.error(f"API error {resp.status}: {error_text}")
-                            return f"API ошибка {resp.status}. Попробуй позже."
-            except asyncio.TimeoutError:
-                logging.warning(f"Timeout attempt {attempt + 1}/3")
-                if attempt < 2:
-                    await asyncio.sleep(2)
-                    continue
-                return "Запрос занял слишком много времени. Попробуй упростить вопрос."
-            except Exception as e:
-                logging.error(f"Query error on attempt {attempt + 1}: {e}", exc_info=True)
+                call = HedgedCall(payload, on_partial)
+                answer, usage, answered_by = await call.run(routed, hedge_model)
+            except UpstreamError as e:
+                PERPLEXITY_ERRORS.inc(e.reason)
+                if e.reason == "429":
+                    admission.report_throttled(e.retry_after)
+                    if attempt < 2:
+                        PERPLEXITY_RETRIES.inc("429")
+                        continue
+                    return "Слишком много запросов. Попробуй через минуту.", False
+                if e.status is not None:
+                    return f"API ошибка {e.status}. Попробуй позже.", False
+                logging.warning(f"Perplexity {e.reason} on attempt {attempt + 1}/3")
                 if attempt < 2:
+                    PERPLEXITY_RETRIES.inc(e.reason)
                     await asyncio.sleep(2)
                     continue
-                return "Ошибка при обработке запроса."
+                if e.reason == "timeout":
+                    return "Запрос занял слишком много времени. Попробуй упростить вопрос.", False
+                return "Ошибка при обработке запроса.", False
+            admission.report_success()
+            if usage:
+                usage_tracker.record(chat_id, user_id, answered_by, usage)
+                # Проигравший дубль прочитал тот же промпт; токены ответа неизвестны, считаем только промпт
+                for lost_model in call.abandoned:
+                    usage_tracker.record(chat_id, user_id, lost_model, {"prompt_tokens": usage.get("prompt_tokens")})
+            answer = sanitizer.clean(answer or "")
+            if not answer:
+                return "Не смог сформулировать ответ. Попробуй переформулировать.", False
+            return answer, True
         
-        return "Не удалось получить ответ после 3 попыток."
+        return "Не удалось получить ответ после 3 попыток.", False
         
     except Exception as e:
         logging.error(f"Perplexity query error: {e}", exc_info=True)
-        return "Ошибка при обработке запроса."
+        return "Ошибка при обработке запроса.", False
 
-async def on_startup(dp):
+class FastWebhookHandler(WebhookRequestHandler):
+    """Сразу отвечает Telegram 200 и обрабатывает апдейт в фоне."""
+
+    async def post(self):
+        # Как в WebhookRequestHandler.post: без этого check_ip у executor не работает
+        self.validate_ip()
+        if WEBHOOK_SECRET:
+            token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                raise web.HTTPUnauthorized()
+        dispatcher = self.get_dispatcher()
+        update = await self.parse_update(dispatcher.bot)
+        task = asyncio.create_task(dispatcher.updates_handler.notify(update))
+        inflight_updates.add(task)
+        task.add_done_callback(_finish_update)
+        return web.Response(text="ok")
+
+inflight_updates = set()
+
+def _finish_update(task: asyncio.Task):
+    inflight_updates.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("Update handling failed", exc_info=task.exception())
+
+async def drain_updates():
+    if not inflight_updates:
+        return
+    logging.info(f"Waiting for {len(inflight_updates)} updates in progress")
+    done, pending = await asyncio.wait(set(inflight_updates), timeout=WEBHOOK_DRAIN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(f"{len(pending)} updates cancelled on shutdown")
+
+metrics_runner: web.AppRunner = None
+
+async def start_services():
+    global metrics_runner
+    if metrics.enabled:
+        metrics_runner = await start_metrics_server()
+        start_background(monitor_event_loop_lag())
+    router.bot_username = (await bot.me).username.lower()
+    await state_backend.open()
+    start_background(phase_scheduler.run())
+    if state_backend.shared:
+        start_background(hold_timer_lease())
+    else:
+        await restore_mafia_timers()
+    get_http_session()
+    await load_users()
+    start_background(user_store.run_flusher())
+    await usage_tracker.open()
+    start_background(usage_tracker.run_flusher())
+    await asyncio.to_thread(answer_cache.load)
+    start_background(answer_cache_saver())
+
+async def stop_services():
+    await drain_updates()
+    for task in list(background_tasks):
+        task.cancel()
+    if state_backend.shared:
+        await release_timer_lease()
+    await close_http_session()
+    await answer_cache.save()
+    await user_store.close()
+    await usage_tracker.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def register_webhook():
     await bot.delete_my_commands()
-    logging.info(f"Бот запущен для групп: {ALLOWED_CHAT_IDS}")
+    if BOT_MODE == "webhook":
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            drop_pending_updates=True,
+        )
+
+async def on_startup(dp):
+    await start_services()
+    await register_webhook()
+    logging.info(f"Бот запущен ({BOT_MODE}) для групп: {ALLOWED_CHAT_IDS}")
+
+async def on_shutdown(dp):
+    await stop_services()
+
+# === ВОРКЕРЫ ===
+def update_chat_id(update: types.Update) -> int:
+    """Ключ шардирования: чат, к которому относится апдейт."""
+    callback = update.callback_query
+    if callback is not None:
+        # Ночные действия мафии приходят из лички, а относятся к игре в группе
+        if callback.data and callback.data.startswith("mafia_act:"):
+            return int(callback.data.split(":")[1])
+        if callback.message is not None:
+            return callback.message.chat.id
+        return callback.from_user.id
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, kind)
+        if message is not None:
+            return message.chat.id
+    for kind in ("my_chat_member", "chat_member", "chat_join_request"):
+        event = getattr(update, kind)
+        if event is not None:
+            return event.chat.id
+    for kind in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "poll_answer"):
+        event = getattr(update, kind)
+        if event is not None:
+            return event.from_user.id if kind != "poll_answer" else event.user.id
+    return 0
+
+class WorkerPool:
+    """Процессы-воркеры, у каждого свой канал апдейтов.
+
+    Чат всегда попадает в один и тот же воркер, поэтому порядок апдейтов
+    чата и его игра в GameStore остаются внутри одного процесса. Воркер,
+    который упал или перестал обновлять heartbeat, перезапускается.
+    Апдейты, еще не отправленные в канал, дождутся нового воркера; то, что
+    уже лежало в канале умершего, теряется.
+    """
+
+    def __init__(self, size: int):
+        self.context = multiprocessing.get_context("spawn")
+        self.pending = [deque() for _ in range(size)]
+        self.wakeups = [asyncio.Event() for _ in range(size)]
+        self.writers = [None] * size
+        self.heartbeats = [self.context.Value("d", 0.0, lock=False) for _ in range(size)]
+        self.processes = [None] * size
+        self.feeders = []
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self._spawn(index)
+            self.feeders.append(asyncio.create_task(self.feed(index)))
+        logging.info(f"Started {len(self.processes)} workers")
+
+    def _spawn(self, index: int):
+        if self.writers[index] is not None:
+            self.writers[index].close()
+        # Канал читает только воркер, без общих блокировок: убитый воркер не подвесит следующий
+        reader, self.writers[index] = self.context.Pipe(duplex=False)
+        # Запас на импорт и on_startup, пока воркер не начал слать heartbeat
+        self.heartbeats[index].value = time.time() + WORKER_HEARTBEAT_TIMEOUT
+        # Индекс передается через окружение: модуль воркера читает его при импорте
+        os.environ["BOT_WORKER_INDEX"] = str(index)
+        try:
+            process = self.context.Process(target=run_worker, args=(reader, self.heartbeats[index]), name=f"worker-{index}")
+            process.start()
+        finally:
+            del os.environ["BOT_WORKER_INDEX"]
+        reader.close()
+        self.processes[index] = process
+
+    def dispatch(self, update: types.Update):
+        index = shard_ring.node(update_chat_id(update))
+        self.pending[index].append(update.to_python())
+        self.wakeups[index].set()
+        WORKER_UPDATES.inc(str(index))
+
+    async def feed(self, index: int):
+        """Пересылает накопленные апдейты воркеру пачками; запись в канал идет в потоке."""
+        pending = self.pending[index]
+        while True:
+            await self.wakeups[index].wait()
+            self.wakeups[index].clear()
+            while pending:
+                batch = list(pending)
+                try:
+                    await asyncio.to_thread(self.writers[index].send, batch)
+                except (OSError, ValueError):
+                    # Воркер умер: пачка подождет перезапуска
+                    await asyncio.sleep(WORKER_CHECK_INTERVAL)
+                    continue
+                for _ in batch:
+                    pending.popleft()
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for index, process in enumerate(self.processes):
+                stale = time.time() - self.heartbeats[index].value > WORKER_HEARTBEAT_TIMEOUT
+                if process.is_alive() and not stale:
+                    continue
+                if process.is_alive():
+                    logging.error(f"Worker {index} missed its heartbeat, killing it")
+                    process.kill()
+                    await asyncio.to_thread(process.join, 5)
+                else:
+                    logging.error(f"Worker {index} exited with code {process.exitcode}")
+                WORKER_RESTARTS.inc(str(index))
+                self._spawn(index)
+
+    async def stop(self, timeout: float):
+        # None в конце очереди: воркер доделает полученное и выйдет
+        for index in range(len(self.processes)):
+            self.pending[index].append(None)
+            self.wakeups[index].set()
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            await asyncio.to_thread(process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"Worker {index} did not stop in time, terminating")
+                process.terminate()
+                await asyncio.to_thread(process.join, 5)
+        for task in self.feeders:
+            task.cancel()
+        for writer in self.writers:
+            writer.close()
+
+class ShardingDispatcher(Dispatcher):
+    """Dispatcher приемника: не обрабатывает апдейты, а передает их воркерам."""
+
+    def __init__(self, bot: Bot, pool: WorkerPool):
+        super().__init__(bot)
+        self.pool = pool
+
+    async def process_update(self, update: types.Update):
+        self.pool.dispatch(update)
+        # Polling ждет список результатов обработчиков
+        return []
+
+async def on_ingester_startup(dispatcher: ShardingDispatcher):
+    global metrics_runner
+    if metrics.enabled:
+        metrics_runner = await start_metrics_server()
+    # Миграция старых JSON-файлов один раз, до того как воркеры откроют базу
+    await user_store.open()
+    await user_store.close()
+    dispatcher.pool.start()
+    start_background(dispatcher.pool.supervise())
+    await register_webhook()
+    logging.info(f"Бот запущен ({BOT_MODE}) с {BOT_WORKERS} воркерами для групп: {ALLOWED_CHAT_IDS}")
+
+async def on_ingester_shutdown(dispatcher: ShardingDispatcher):
+    await drain_updates()
+    for task in list(background_tasks):
+        task.cancel()
+    await dispatcher.pool.stop(WORKER_STOP_TIMEOUT)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+def _next_batch(reader, parent_pid: int):
+    while not reader.poll(1.0):
+        if os.getppid() != parent_pid:
+            # Приемник умер, новых апдейтов не будет
+            return [None]
+    try:
+        return reader.recv()
+    except EOFError:
+        return [None]
+
+async def heartbeat_loop(heartbeat):
+    while True:
+        heartbeat.value = time.time()
+        await asyncio.sleep(1)
+
+async def serve_worker(reader, heartbeat, parent_pid: int):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await start_services()
+    start_background(heartbeat_loop(heartbeat))
+    logging.info(f"Worker {BOT_WORKER_INDEX} ready")
+    loop = asyncio.get_running_loop()
+    try:
+        running = True
+        while running:
+            for data in await loop.run_in_executor(None, _next_batch, reader, parent_pid):
+                if data is None:
+                    running = False
+                    break
+                task = asyncio.create_task(dp.updates_handler.notify(types.Update.to_object(data)))
+                inflight_updates.add(task)
+                task.add_done_callback(_finish_update)
+    finally:
+        await stop_services()
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await bot.get_session()).close()
+        logging.info(f"Worker {BOT_WORKER_INDEX} stopped")
+
+def run_worker(reader, heartbeat):
+    # Ctrl+C приходит всей группе процессов, а останавливает воркеры приемник
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(reader, heartbeat, os.getppid()))
 
 # === МАФИЯ ===
+async def send_to_players(game: MafiaGame, messages: list) -> list:
+    """Рассылает личные сообщения параллельно и возвращает игроков, которым не удалось написать."""
+    limit = asyncio.Semaphore(MAFIA_DM_CONCURRENCY)
+    
+    async def send(player: MafiaPlayer, text: str, markup):
+        async with limit:
+            await outbox.send_message(player.id, text, reply_markup=markup)
+    
+    results = await asyncio.gather(*(send(*m) for m in messages), return_exceptions=True)
+    failed = []
+    for (player, _, _), result in zip(messages, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Mafia DM to {player.id} in chat {game.chat_id} failed: {result}")
+            failed.append(player)
+    return failed
+
+async def send_roles(game: MafiaGame) -> list:
+    return await send_to_players(
+        game,
+        [(p, f"Ваша роль: {MAFIA_ROLE_TEXT[p.role]}", None) for p in game.players.values()],
+    )
+
+async def send_night_prompts(game: MafiaGame):
+    messages = []
+    for actor in game.night_actors():
+        kb = types.InlineKeyboardMarkup(row_width=2)
+        kb.add(*(
+            types.InlineKeyboardButton(p.name, callback_data=f"mafia_act:{game.chat_id}:{game.phase_id}:{p.id}")
+            for p in game.night_targets(actor)
+        ))
+        messages.append((actor, MAFIA_NIGHT_PROMPTS[actor.role].format(day=game.day_num), kb))
+    await send_to_players(game, messages)
+
+def find_player(game: MafiaGame, arg: str):
+    arg = arg.strip()
+    if arg.startswith("@"):
+        username = arg[1:].lower()
+        members = user_registry.chats.get(game.chat_id, {})
+        for p in game.alive_players():
+            uname = members.get(p.id, (None, None))[0]
+            if uname and uname.lower() == username:
+                return p
+        return None
+    name = arg.casefold()
+    return next((p for p in game.alive_players() if p.name.casefold() == name), None) if name else None
+
+def retry_on_conflict(handler):
+    """Повторяет обработчик игры, если ее успела изменить другая реплика.
+
+    Обработчик должен сохранить игру до первого сообщения или ответа на кнопку,
+    тогда повтор ничего не отправит дважды.
+    """
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        chat_id = None
+        for attempt in range(STATE_CONFLICT_RETRIES):
+            try:
+                return await handler(*args, **kwargs)
+            except GameConflict as e:
+                chat_id = e.args[0]
+                await asyncio.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+        logging.warning(f"Mafia game in chat {chat_id} keeps changing, {handler.__name__} gave up")
+    return wrapper
+
+async def commit_phase(game: MafiaGame):
+    await mafia_games.save(game)
+    if game.deadline:
+        phase_scheduler.schedule(game.chat_id, game.deadline, game.phase_id)
+
+# Переходы меняют игру синхронно до первого await: второй обработчик того же
+# перехода увидит новый phase_id и ничего не сделает
+async def start_night(game: MafiaGame, prefix: str = "", first: bool = False):
+    await begin_night(game)
+    await announce_night(game, prefix, first)
+
+async def begin_night(game: MafiaGame):
+    game.day_num += 1
+    game.night_actions = {}
+    game.votes = {}
+    game.set_phase("night", MAFIA_NIGHT_SECONDS)
+    await commit_phase(game)
+
+async def announce_night(game: MafiaGame, prefix: str = "", first: bool = False):
+    failed = await send_roles(game) if first else []
+    await outbox.send_message(
+        game.chat_id,
+        f"{prefix}Наступает ночь {game.day_num}.\n\n"
+        f"Мафия и специальные роли делают свой ход в личных сообщениях.\n"
+        f"Утро через {int(MAFIA_NIGHT_SECONDS)} сек. Начать день сразу: /mafia_day"
+    )
+    if failed:
+        await outbox.send_message(
+            game.chat_id,
+            f"Не удалось отправить роль: {', '.join(p.name for p in failed)}.\n"
+            f"Напишите боту в личные сообщения и попросите роль у ведущего."
+        )
+    await send_night_prompts(game)
+
+async def start_day(game: MafiaGame):
+    victim = game.resolve_night()
+    game.night_victim = victim.id if victim else None
+    news = f"Этой ночью убит(а) {victim.name}.\n\n" if victim else "Этой ночью никто не погиб.\n\n"
+    winner = game.winner()
+    if winner:
+        await end_game(game, winner, news)
+        return
+    game.set_phase("day", MAFIA_DAY_SECONDS)
+    await commit_phase(game)
+    alive_players = game.alive_players()
+    alive_names = ", ".join(p.name for p in alive_players)
+    await outbox.send_message(
+        game.chat_id,
+        f"{news}День {game.day_num}\n\n"
+        f"Живые игроки ({len(alive_players)}):\n{alive_names}\n\n"
+        f"Обсуждайте, голосование начнется через {int(MAFIA_DAY_SECONDS)} сек.\n"
+        f"Используй /mafia_vote @username для голосования\n"
+        f"Используй /mafia_night чтобы подвести итоги и перейти в ночь"
+    )
+
+async def start_vote(game: MafiaGame):
+    if game.votes_done():
+        await finish_vote(game)
+        return
+    game.set_phase("vote", MAFIA_VOTE_SECONDS)
+    await commit_phase(game)
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(*(
+        types.InlineKeyboardButton(p.name, callback_data=f"mafia_vote:{game.phase_id}:{p.id}")
+        for p in game.alive_players()
+    ))
+    await outbox.send_message(
+        game.chat_id,
+        f"Голосование! Кого исключаем? Осталось {int(MAFIA_VOTE_SECONDS)} сек.\n"
+        f"Уже проголосовали: {len(game.votes)} из {len(game.alive)}",
+        reply_markup=kb
+    )
+
+async def finish_vote(game: MafiaGame):
+    victim = game.resolve_vote()
+    news = f"По итогам голосования исключен(а) {victim.name}.\n\n" if victim else "Голоса разделились, никого не исключили.\n\n"
+    winner = game.winner()
+    if winner:
+        await end_game(game, winner, news)
+        return
+    if victim is None and game.night_victim is None:
+        game.idle_rounds += 1
+    if MAFIA_IDLE_ROUNDS and game.idle_rounds >= MAFIA_IDLE_ROUNDS:
+        await close_game(game, "Игра завершена из-за неактивности.", news)
+        return
+    if MAFIA_MAX_DAYS and game.day_num >= MAFIA_MAX_DAYS:
+        await close_game(game, f"Игра завершена: прошло {game.day_num} дней, а победителя нет.", news)
+        return
+    await start_night(game, news)
+
+async def end_game(game: MafiaGame, winner: str, prefix: str = ""):
+    if winner == 'citizens':
+        result = "Мирные жители победили! Вся мафия устранена."
+    else:
+        result = "Мафия победила! Мафии столько же или больше чем мирных."
+    await close_game(game, result, prefix)
+
+async def close_game(game: MafiaGame, result: str, prefix: str = ""):
+    game.set_phase("over")
+    await mafia_games.delete(game)
+    roles = "\n".join(f"{p.name} - {MAFIA_ROLE_NAMES[p.role]}" for p in game.players.values())
+    await outbox.send_message(game.chat_id, f"{prefix}{result}\n\nРоли:\n{roles}")
+
+@retry_on_conflict
+async def advance_phase(chat_id: int, phase_id: int):
+    game = await mafia_games.get(chat_id)
+    if game is None or game.phase_id != phase_id:
+        return
+    if game.phase == "night":
+        await start_day(game)
+    elif game.phase == "day":
+        await start_vote(game)
+    elif game.phase == "vote":
+        await finish_vote(game)
+
+phase_scheduler = PhaseScheduler(advance_phase)
+
+async def restore_mafia_timers():
+    # С общим бэкендом таймеры всех игр держит владелец аренды, иначе процесс берет свои чаты
+    restored = 0
+    for chat_id, deadline, phase_id in await mafia_games.deadlines():
+        if state_backend.shared or owns_chat(chat_id):
+            restored += phase_scheduler.schedule(chat_id, deadline, phase_id)
+    if restored:
+        logging.info(f"Restored {restored} mafia phase timers")
+
+TIMER_LEASE_KEY = "lease:mafia_timers"
+replica_id = f"{socket.gethostname()}:{os.getpid()}"
+
+async def hold_timer_lease():
+    """Аренда таймеров фаз для общего бэкенда.
+
+    Реплика сама запускает таймеры фаз, которые начала, а таймеры остальных
+    игр, включая игры упавших реплик, держит одна реплика - владелец аренды.
+    Она продлевает аренду раз в треть срока и заодно перечитывает дедлайны.
+    Если таймер сработает в двух репликах, переход запишет только одна.
+    """
+    owner = False
+    while True:
+        try:
+            was_owner = owner
+            owner = await state_backend.compare_and_set(
+                TIMER_LEASE_KEY, replica_id if owner else None, replica_id, ttl=STATE_TIMER_LEASE
+            )
+            if owner and not was_owner:
+                logging.info(f"Mafia phase timers taken over by {replica_id}")
+            if owner:
+                await restore_mafia_timers()
+        except StateBackendError as e:
+            owner = False
+            logging.warning(f"Timer lease error: {e}")
+        await asyncio.sleep(STATE_TIMER_LEASE / 3)
+
+async def release_timer_lease():
+    try:
+        await state_backend.compare_and_set(TIMER_LEASE_KEY, replica_id, None)
+    except StateBackendError as e:
+        logging.warning(f"Timer lease release error: {e}")
+
 @dp.message_handler(is_allowed_chat, commands=['mafia'])
+@retry_on_conflict
 async def cmd_mafia(message: types.Message):
     chat_id = message.chat.id
     
-    if chat_id in mafia_games:
-        await message.reply("Игра уже идет. Используй /mafia_stop чтобы остановить.")
+    if await mafia_games.get(chat_id) is not None:
+        await outbox.reply(message, "Игра уже идет. Используй /mafia_stop чтобы остановить.")
         return
     
-    mafia_games[chat_id] = MafiaGame(chat_id)
+    await mafia_games.save(MafiaGame(chat_id))
     
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Войти в игру", callback_data="mafia_join"))
     kb.add(types.InlineKeyboardButton("Начать игру", callback_data="mafia_start"))
     
-    await message.answer(
+    await outbox.answer(
+        message,
         "Игра МАФИЯ\n\n"
         "Роли:\n"
         "Мафия - убивает игроков ночью\n"
@@ -245,293 +3201,411 @@ async def cmd_mafia(message: types.Message):
     )
 
 @dp.callback_query_handler(lambda c: c.data == "mafia_join")
+@retry_on_conflict
 async def mafia_join(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     
-    if chat_id not in mafia_games:
+    game = await mafia_games.get(chat_id)
+    if game is None:
         await callback.answer("Игра не найдена", show_alert=True)
         return
-    
-    game = mafia_games[chat_id]
     user = callback.from_user
     
-    if user.id in [p['id'] for p in game.players]:
-        await callback.answer("Ты уже в игре")
+    if game.phase != "registration":
+        await callback.answer("Игра уже началась")
         return
     
-    game.players.append({
-        'id': user.id,
-        'name': user.first_name,
-        'role': None,
-        'alive': True
-    })
+    if not game.add_player(user.id, user.first_name):
+        await callback.answer("Ты уже в игре")
+        return
+    await mafia_games.save(game)
     
     await callback.answer("Ты в игре")
-    await callback.message.answer(f"{user.first_name} присоединился. Всего игроков: {len(game.players)}")
+    await outbox.answer(callback.message, f"{user.first_name} присоединился. Всего игроков: {len(game.players)}")
 
 @dp.callback_query_handler(lambda c: c.data == "mafia_start")
+@retry_on_conflict
 async def mafia_start(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     
-    if chat_id not in mafia_games:
+    game = await mafia_games.get(chat_id)
+    if game is None:
         await callback.answer("Игра не найдена", show_alert=True)
         return
     
-    game = mafia_games[chat_id]
+    if game.phase != "registration":
+        await callback.answer("Игра уже началась")
+        return
     
     if len(game.players) < 4:
         await callback.answer("Нужно минимум 4 игрока", show_alert=True)
         return
     
-    players = game.players.copy()
-    random.shuffle(players)
-    
-    mafia_count = max(1, len(players) // 3)
-    for i in range(mafia_count):
-        players[i]['role'] = 'mafia'
-        game.mafia.append(players[i]['id'])
-    
-    players[mafia_count]['role'] = 'detective'
-    game.detective = players[mafia_count]['id']
+    # Фаза меняется до первого await: второй клик по кнопке увидит, что игра уже идет
+    game.assign_roles()
+    await begin_night(game)
+    await callback.answer()
+    await announce_night(
+        game,
+        f"Игра началась. Участвует {len(game.players)} игроков. Роли отправлены в личные сообщения.\n\n",
+        first=True,
+    )
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("mafia_act:"))
+@retry_on_conflict
+async def mafia_act(callback: types.CallbackQuery):
+    _, chat_id, phase_id, target_id = callback.data.split(":")
+    chat_id, phase_id, target_id = int(chat_id), int(phase_id), int(target_id)
     
-    if len(players) > mafia_count + 1:
-        players[mafia_count + 1]['role'] = 'doctor'
-        game.doctor = players[mafia_count + 1]['id']
+    game = await mafia_games.get(chat_id) if chat_id in ALLOWED_CHAT_IDS else None
+    if game is None or game.phase != "night" or game.phase_id != phase_id:
+        await callback.answer("Эта ночь уже закончилась", show_alert=True)
+        return
     
-    for i in range(mafia_count + 2, len(players)):
-        players[i]['role'] = 'citizen'
+    actor = game.players.get(callback.from_user.id)
+    if actor is None or actor not in game.night_actors():
+        await callback.answer("Вы не ходите этой ночью", show_alert=True)
+        return
     
-    game.alive = [p['id'] for p in players]
-    game.phase = "night"
-    game.day_num = 1
+    if actor.id in game.night_actions:
+        await callback.answer("Вы уже сделали ход")
+        return
     
-    role_text = {
-        'mafia': 'Вы МАФИЯ. Убивайте мирных жителей.',
-        'detective': 'Вы ДЕТЕКТИВ. Проверяйте подозрительных.',
-        'doctor': 'Вы ДОКТОР. Спасайте игроков.',
-        'citizen': 'Вы МИРНЫЙ ЖИТЕЛЬ. Ищите мафию.'
-    }
+    target = game.players.get(target_id)
+    if target is None or target not in game.night_targets(actor):
+        await callback.answer("Этого игрока выбрать нельзя", show_alert=True)
+        return
     
-    for player in players:
-        try:
-            await bot.send_message(player['id'], f"Ваша роль: {role_text[player['role']]}")
-        except:
-            pass
+    game.night_actions[actor.id] = target.id
+    game.idle_rounds = 0
+    if actor.role == 'detective':
+        result = f"Ваш выбор: {target.name}. {'Это МАФИЯ!' if target.id in game.mafia else 'Это не мафия.'}"
+    else:
+        result = f"Ваш выбор: {target.name}"
+    night_done = game.night_done()
+    await mafia_games.save(game)
     
-    await callback.answer()
-    await callback.message.answer(
-        f"Игра началась. Участвует {len(players)} игроков.\n"
-        f"День {game.day_num}: Наступает ночь. Роли отправлены в личные сообщения.\n\n"
-        f"Мафия и специальные роли делают свой ход.\n"
-        f"Утром используй /mafia_day для начала дня."
-    )
+    # Отвечаем до перехода: его сообщения могут долго стоять в очереди группы
+    await callback.answer("Ход принят")
+    await outbox.edit_text(callback.message.chat.id, callback.message.message_id, result)
+    if night_done:
+        await advance_phase(chat_id, phase_id)
 
-@dp.message_handler(is_allowed_chat, commands=['mafia_day'])
-async def cmd_mafia_day(message: types.Message):
-    chat_id = message.chat.id
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("mafia_vote:"))
+@retry_on_conflict
+async def mafia_vote_button(callback: types.CallbackQuery):
+    _, phase_id, target_id = callback.data.split(":")
     
-    if chat_id not in mafia_games:
-        await message.reply("Игра не идет")
+    game = await mafia_games.get(callback.message.chat.id)
+    if game is None or game.phase_id != int(phase_id):
+        await callback.answer("Голосование уже закончилось", show_alert=True)
         return
     
-    game = mafia_games[chat_id]
+    await cast_vote(game, callback.from_user.id, game.players.get(int(target_id)), callback.answer)
+
+@dp.message_handler(is_allowed_chat, commands=['mafia_vote'])
+@retry_on_conflict
+async def cmd_mafia_vote(message: types.Message):
+    game = await mafia_games.get(message.chat.id)
+    if game is None:
+        await outbox.reply(message, "Игра не идет")
+        return
     
-    if game.phase != "night":
-        await message.reply("Сейчас не ночь")
+    if game.phase not in ("day", "vote"):
+        await outbox.reply(message, "Сейчас не время голосовать")
         return
     
-    game.phase = "day"
+    target = find_player(game, message.get_args() or "")
     
-    alive_players = [p for p in game.players if p['id'] in game.alive]
-    alive_names = ", ".join([p['name'] for p in alive_players])
+    async def respond(text, show_alert=False):
+        await outbox.reply(message, text)
     
-    mafia_alive = [p for p in game.players if p['id'] in game.mafia and p['id'] in game.alive]
-    citizens_alive = [p for p in alive_players if p['id'] not in game.mafia]
+    await cast_vote(game, message.from_user.id, target, respond)
+
+async def cast_vote(game: MafiaGame, voter_id: int, target: MafiaPlayer, respond):
+    voter = game.players.get(voter_id)
+    if voter is None or not voter.alive:
+        await respond("Голосуют только живые игроки", show_alert=True)
+        return
     
-    if not mafia_alive:
-        await message.answer(f"Мирные жители победили! Вся мафия устранена.")
-        del mafia_games[chat_id]
+    if target is None or not target.alive:
+        await respond("Такого живого игрока нет", show_alert=True)
         return
     
-    if len(citizens_alive) <= len(mafia_alive):
-        await message.answer(f"Мафия победила! Мафии столько же или больше чем мирных.")
-        del mafia_games[chat_id]
+    game.votes[voter.id] = target.id
+    game.idle_rounds = 0
+    votes_done = game.phase == "vote" and game.votes_done()
+    await mafia_games.save(game)
+    await respond(f"{voter.name} голосует против {target.name}")
+    if votes_done:
+        # Повторный переход по тому же phase_id advance_phase отбросит
+        await advance_phase(game.chat_id, game.phase_id)
+
+@dp.message_handler(is_allowed_chat, commands=['mafia_day'])
+@retry_on_conflict
+async def cmd_mafia_day(message: types.Message):
+    game = await mafia_games.get(message.chat.id)
+    if game is None:
+        await outbox.reply(message, "Игра не идет")
         return
     
-    await message.answer(
-        f"День {game.day_num}\n\n"
-        f"Живые игроки ({len(alive_players)}):\n{alive_names}\n\n"
-        f"Обсуждайте и голосуйте кого исключить.\n"
-        f"Используй /mafia_vote @username для голосования\n"
-        f"Используй /mafia_night для перехода в ночь"
-    )
+    if game.phase != "night":
+        await outbox.reply(message, "Сейчас не ночь")
+        return
+    
+    await start_day(game)
 
 @dp.message_handler(is_allowed_chat, commands=['mafia_night'])
+@retry_on_conflict
 async def cmd_mafia_night(message: types.Message):
-    chat_id = message.chat.id
-    
-    if chat_id not in mafia_games:
-        await message.reply("Игра не идет")
+    game = await mafia_games.get(message.chat.id)
+    if game is None:
+        await outbox.reply(message, "Игра не идет")
         return
     
-    game = mafia_games[chat_id]
-    
-    if game.phase != "day":
-        await message.reply("Сейчас не день")
+    if game.phase not in ("day", "vote"):
+        await outbox.reply(message, "Сейчас не день")
         return
     
-    game.phase = "night"
-    game.day_num += 1
-    game.night_actions = {}
-    
-    await message.answer(
-        f"Наступает ночь {game.day_num}.\n\n"
-        f"Мафия и специальные роли делают свой ход.\n"
-        f"Утром используй /mafia_day"
-    )
+    await finish_vote(game)
 
 @dp.message_handler(is_allowed_chat, commands=['mafia_stop'])
+@retry_on_conflict
 async def cmd_mafia_stop(message: types.Message):
-    chat_id = message.chat.id
-    if chat_id in mafia_games:
-        del mafia_games[chat_id]
-        await message.reply("Игра остановлена")
+    game = await mafia_games.get(message.chat.id)
+    if game is not None:
+        await mafia_games.delete(game)
+        await outbox.reply(message, "Игра остановлена")
     else:
-        await message.reply("Игра не идет")
+        await outbox.reply(message, "Игра не идет")
 
 # === ОСТАЛЬНЫЕ ХЕНДЛЕРЫ ===
-@dp.message_handler(is_allowed_chat, content_types=types.ContentTypes.NEW_CHAT_MEMBERS)
-async def on_join(message: types.Message):
-    for u in message.new_chat_members:
-        if not u.is_bot:
-            udata = (u.id, u.username, u.first_name)
-            known_users.discard(next((x for x in known_users if x[0] == u.id), None))
-            known_users.add(udata)
-            save_users()
+class MessageRouter:
+    """Находит триггер сообщения одним регулярным выражением.
 
-@dp.message_handler(is_allowed_chat, content_types=types.ContentTypes.ANY)
-async def main_handler(message: types.Message):
-    if not message.from_user.is_bot:
-        u = message.from_user
-        udata = (u.id, u.username, u.first_name)
-        if udata not in known_users:
-            known_users.discard(next((x for x in known_users if x[0] == u.id), None))
-            known_users.add(udata)
-            save_users()
-    
-    text = (message.text or message.caption or "").strip()
-    text_lower = text.lower()
-    
-    if text.startswith('/tip'):
-        args = re.findall(r'"([^"]*)"', text)
-        if len(args) == 2:
-            nickname = args[0]
-            target_username = args[1].replace('@', '').strip()
-            if target_username:
-                nicknames[target_username.lower()] = nickname
-                save_nicks()
-                await message.reply(f"Запомнил, @{target_username} теперь {nickname}.")
+    Обычные сообщения чата отсекаются по первому символу, без regex.
+    Команды понимают суффикс /cmd@botname, команды другим ботам игнорируются.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.commands = set()
+        self.prefixes = set()
+        self.first_chars = frozenset()
+        self.pattern = None
+        self.bot_username = None
+
+    def command(self, *names: str, group: bool = True, private: bool = False):
+        return self._register(names, self.commands, group, private)
+
+    def prefix(self, *words: str, group: bool = True, private: bool = False):
+        return self._register(words, self.prefixes, group, private)
+
+    def _register(self, triggers, kind: set, group: bool, private: bool):
+        def decorator(handler):
+            for trigger in triggers:
+                trigger = trigger.lower()
+                kind.add(trigger)
+                if group:
+                    self.routes[(trigger, False)] = handler
+                if private:
+                    self.routes[(trigger, True)] = handler
+            self.pattern = None
+            return handler
+        return decorator
+
+    def compile(self):
+        alternatives = []
+        if self.commands:
+            commands = "|".join(map(re.escape, sorted(self.commands, key=len, reverse=True)))
+            alternatives.append(rf"/(?P<cmd>{commands})(?:@(?P<bot>\w+))?(?=\s|$)")
+        if self.prefixes:
+            prefixes = "|".join(map(re.escape, sorted(self.prefixes, key=len, reverse=True)))
+            alternatives.append(rf"(?P<prefix>{prefixes})")
+        self.pattern = re.compile("|".join(alternatives), re.IGNORECASE)
+        self.first_chars = frozenset({"/"} | {c for p in self.prefixes for c in (p[0].lower(), p[0].upper())})
+
+    def match(self, text: str):
+        """(триггер, аргументы) или None."""
+        if self.pattern is None:
+            self.compile()
+        if not text or text[0] not in self.first_chars:
+            return None
+        m = self.pattern.match(text)
+        if m is None:
+            return None
+        if m.group("cmd"):
+            bot_name = m.group("bot")
+            if bot_name and self.bot_username and bot_name.lower() != self.bot_username:
+                return None
+            return m.group("cmd").lower(), text[m.end():].strip()
+        return m.group("prefix").lower(), text[m.end():].strip()
+
+    async def dispatch(self, message: types.Message, private: bool) -> bool:
+        text = message.text or message.caption
+        if not text:
+            return False
+        found = self.match(text.strip())
+        if found is None:
+            return False
+        handler = self.routes.get((found[0], private))
+        if handler is None:
+            return False
+        with COMMAND_SECONDS.time(found[0]):
+            await handler(message, found[1])
+        return True
+
+router = MessageRouter()
+
+SCHOOL_KEYWORDS_RE = re.compile("реши|решить|задач|пример|уравнение|формул|теорем")
+TIP_ARGS_RE = re.compile(r'"([^"]*)"')
+
+@router.command("tip")
+async def handle_tip(message: types.Message, args: str):
+    quoted = TIP_ARGS_RE.findall(args)
+    if len(quoted) == 2:
+        nickname = quoted[0]
+        target_username = quoted[1].replace('@', '').strip()
+        if target_username:
+            user_registry.set_nickname(target_username, nickname)
+            user_store.set_nickname(target_username.lower(), nickname)
+            await outbox.reply(message, f"Запомнил, @{target_username} теперь {nickname}.")
+
+@router.command("all", "tagall")
+async def handle_all(message: types.Message, args: str):
+    if BOT_WORKER_INDEX >= 0:
+        await sync_nicknames()
+    chunks = user_registry.mention_chunks(message.chat.id)
+    if not chunks:
+        await outbox.reply(message, "Пусто.")
         return
-    
-    if text.startswith('/all') or text.startswith('/tagall'):
-        if not known_users:
-            await message.reply("Пусто.")
+    await outbox.answer(message, "Общий сбор:", priority=PRIORITY_LOW)
+    await asyncio.gather(*(outbox.answer(message, chunk, priority=PRIORITY_LOW, parse_mode="HTML") for chunk in chunks))
+
+@router.command("cache", group=False, private=True)
+async def handle_cache(message: types.Message, args: str):
+    stats = answer_cache.stats()
+    context = conversations.stats()
+    await outbox.reply(
+        message,
+        f"Кэш ответов: {stats['entries']} записей\n"
+        f"Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate']:.0%})\n"
+        f"Контекст разговоров: {context['chats']} чатов, {context['messages']} сообщений, "
+        f"{context['bytes'] // 1024} КБ"
+    )
+
+def _user_label(user_id: int) -> str:
+    for members in user_registry.chats.values():
+        if user_id in members:
+            username, first_name = members[user_id]
+            return f"@{username}" if username else (first_name or str(user_id))
+    return str(user_id)
+
+@router.command("usage", group=False, private=True)
+async def handle_usage(message: types.Message, args: str):
+    days = min(90, max(1, int(args))) if args.strip().isdigit() else 1
+    report = await usage_tracker.report(days)
+    if not report["models"]:
+        await outbox.reply(message, f"С {report['since']} (UTC) запросов к Perplexity не было.")
+        return
+    lines = [f"Расход с {report['since']} (UTC):"]
+    total = 0.0
+    for model, (requests, prompt_tokens, completion_tokens, cost) in sorted(report["models"].items()):
+        lines.append(f"{model}: {requests} запросов, {prompt_tokens} + {completion_tokens} токенов, ${cost:.4f}")
+        total += cost
+    lines.append(f"Итого: ${total:.4f}")
+    lines.append("\nЧаты:")
+    lines.extend(f"{chat_id}: ${cost:.4f}" for chat_id, cost in report["chats"])
+    lines.append("\nПользователи:")
+    lines.extend(f"{_user_label(user_id)}: ${cost:.4f}" for user_id, cost in report["users"])
+    if USAGE_CHAT_DAILY_USD or USAGE_USER_DAILY_USD:
+        chat_limit = f"${USAGE_CHAT_DAILY_USD:g}" if USAGE_CHAT_DAILY_USD else "нет"
+        user_limit = f"${USAGE_USER_DAILY_USD:g}" if USAGE_USER_DAILY_USD else "нет"
+        lines.append(f"\nДневные лимиты: чат {chat_limit}, пользователь {user_limit}")
+    await outbox.reply(message, "\n".join(lines), parse_mode=None)
+
+@router.command("ask", private=True)
+@router.prefix("улитка", private=True)
+async def handle_ask(message: types.Message, question: str):
+    photo = None
+    if message.photo:
+        try:
+            photo = await load_photo(message.photo)
+        except PhotoTooLarge:
+            await outbox.reply(message, "Фото слишком большое. Максимум 20 МБ.")
             return
-        mentions = []
-        for uid, uname, fname in known_users:
-            if uname:
-                mentions.append(f"@{uname}")
-            else:
-                mentions.append(f"{fname}")
-        chunk_size = 30
-        chunks = [mentions[i:i+chunk_size] for i in range(0, len(mentions), chunk_size)]
-        await message.answer("Общий сбор:")
-        for chunk in chunks:
-            await message.answer(" ".join(chunk), parse_mode="HTML")
+        except Exception as e:
+            logging.error(f"Photo download error: {e}")
+            await outbox.reply(message, "Ошибка при загрузке фото.")
+            return
+    
+    if not question and not photo:
         return
     
-    if text.startswith('/ask') or text_lower.startswith('улитка'):
-        question = text
-        if text.startswith('/ask'):
-            question = text[4:].strip()
-        elif text_lower.startswith('улитка'):
-            question = text[6:].strip()
-        
-        photo_base64 = None
-        if message.photo:
-            photo = message.photo[-1]
-            if photo.file_size > 20 * 1024 * 1024:
-                await message.reply("Фото слишком большое. Максимум 20 МБ.")
-                return
-            
-            try:
-                photo_bytes = await download_photo(photo.file_id)
-                photo_base64 = base64.b64encode(photo_bytes).decode('utf-8')
-            except Exception as e:
-                logging.error(f"Photo download error: {e}")
-                await message.reply("Ошибка при загрузке фото.")
-                return
-        
-        if not question and not photo_base64:
-            return
-        
-        if photo_base64 and not question:
-            question = "Реши эту задачу"
-        
-        await bot.send_chat_action(message.chat.id, types.ChatActions.TYPING)
-        
-        school_keywords = ["реши", "решить", "задач", "пример", "уравнение", "формул", "теорем"]
-        is_school = any(keyword in question.lower() for keyword in school_keywords) or photo_base64
-        
-        answer = await ask_perplexity(question=question, is_school_task=is_school, photo_base64=photo_base64)
-        
-        if answer:
-            await message.reply(answer, parse_mode=None)
+    if photo and not question:
+        question = "Реши эту задачу"
+    
+    await bot.send_chat_action(message.chat.id, types.ChatActions.TYPING)
+    
+    is_school = bool(photo) or SCHOOL_KEYWORDS_RE.search(question.lower()) is not None
+    
+    parent_id = message.reply_to_message.message_id if message.reply_to_message else None
+    history = []
+    if parent_id is not None:
+        history = conversations.history(message.chat.id, parent_id, CONTEXT_TOKEN_BUDGET - estimate_tokens(question),
+                                        CONTEXT_MAX_DEPTH)
+    
+    streamer = StreamingReply(message) if STREAM_ANSWERS else None
+    answer, ok = await ask_perplexity(question=question, is_school_task=is_school, photo=photo,
+                                      on_partial=streamer.update if streamer else None,
+                                      user_id=message.from_user.id, chat_id=message.chat.id, history=history)
+    
+    if answer:
+        if streamer:
+            sent_ids = await streamer.finish(answer)
+        else:
+            sent_ids = await reply_answer(message, answer)
+        if ok:
+            conversations.record(message.chat.id, message.message_id, parent_id, question, sent_ids, answer)
+
+async def dispatch_message(message: types.Message, private: bool):
+    if await router.dispatch(message, private):
         return
+    # Ответ на ответ бота без /ask - продолжение разговора
+    reply = message.reply_to_message
+    if reply is not None and conversations.is_answer(message.chat.id, reply.message_id):
+        with COMMAND_SECONDS.time("ask"):
+            await handle_ask(message, (message.text or message.caption or "").strip())
+
+@dp.message_handler(is_allowed_chat, content_types=types.ContentTypes.NEW_CHAT_MEMBERS)
+async def on_join(message: types.Message):
+    for u in message.new_chat_members:
+        if not u.is_bot and user_registry.upsert(message.chat.id, u.id, u.username, u.first_name):
+            user_store.upsert_user(message.chat.id, u.id, u.username, u.first_name)
+
+@dp.message_handler(is_allowed_chat, content_types=types.ContentTypes.ANY)
+async def main_handler(message: types.Message):
+    u = message.from_user
+    if not u.is_bot and user_registry.upsert(message.chat.id, u.id, u.username, u.first_name):
+        user_store.upsert_user(message.chat.id, u.id, u.username, u.first_name)
+    await dispatch_message(message, private=False)
 
-@dp.message_handler(chat_type=types.ChatType.PRIVATE)
+@dp.message_handler(chat_type=types.ChatType.PRIVATE, content_types=types.ContentTypes.ANY)
 async def private_handler(message: types.Message):
     if message.from_user.id == ADMIN_ID:
-        text = (message.text or message.caption or "").strip()
-        text_lower = text.lower()
-        
-        if text.startswith('/ask') or text_lower.startswith('улитка'):
-            question = text
-            if text.startswith('/ask'):
-                question = text[4:].strip()
-            elif text_lower.startswith('улитка'):
-                question = text[6:].strip()
-            
-            photo_base64 = None
-            if message.photo:
-                photo = message.photo[-1]
-                if photo.file_size > 20 * 1024 * 1024:
-                    await message.reply("Фото слишком большое. Максимум 20 МБ.")
-                    return
-                
-                try:
-                    photo_bytes = await download_photo(photo.file_id)
-                    photo_base64 = base64.b64encode(photo_bytes).decode('utf-8')
-                except Exception as e:
-                    logging.error(f"Photo download error: {e}")
-                    await message.reply("Ошибка при загрузке фото.")
-                    return
-            
-            if not question and not photo_base64:
-                return
-            
-            if photo_base64 and not question:
-                question = "Реши эту задачу"
-            
-            await bot.send_chat_action(message.chat.id, types.ChatActions.TYPING)
-            
-            school_keywords = ["реши", "решить", "задач", "пример", "уравнение", "формул", "теорем"]
-            is_school = any(keyword in question.lower() for keyword in school_keywords) or photo_base64
-            
-            answer = await ask_perplexity(question=question, is_school_task=is_school, photo_base64=photo_base64)
-            
-            if answer:
-                await message.reply(answer, parse_mode=None)
+        await dispatch_message(message, private=True)
 
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    if BOT_WORKERS > 1:
+        dispatcher = ShardingDispatcher(bot, WorkerPool(BOT_WORKERS))
+        startup, shutdown = on_ingester_startup, on_ingester_shutdown
+    else:
+        dispatcher, startup, shutdown = dp, on_startup, on_shutdown
+    if BOT_MODE == "webhook":
+        webhook_executor = executor.Executor(dispatcher)
+        webhook_executor.on_startup(startup)
+        webhook_executor.on_shutdown(shutdown)
+        webhook_executor.set_webhook(WEBHOOK_PATH, request_handler=FastWebhookHandler)
+        webhook_executor.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        executor.start_polling(dispatcher, skip_updates=True, on_startup=startup, on_shutdown=shutdown)